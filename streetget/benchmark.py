@@ -0,0 +1,389 @@
+#! /usr/bin/python
+"""
+Micro-benchmarks of the CPU hot paths of Panorama. Network requests
+are served from fixture payloads, either recorded from a real
+panorama or synthesized on the fly.
+
+Usage:
+    benchmark.py run [-f DIR -z ZOOM -n N -b FILE -T TOL -s]
+    benchmark.py record PID DIR [-z ZOOM]
+
+Commands:
+    run         Runs the benchmarks and compares them with the
+                baseline file.
+    record      Records fixture payloads of panorama PID into
+                directory DIR.
+
+Options:
+    -f DIR      Fixture directory created by 'record'. If unset,
+                synthetic payloads are used.
+    -z ZOOM     Comma separated zoom levels [0-5] to be benchmarked
+                [default: 0,1,2,3,4,5]
+    -n N        Number of repetitions per benchmark [default: 5]
+    -b FILE     Baseline file [default: bench_baseline.json]
+    -T TOL      Allowed relative slow down and allocation growth
+                against the baseline
+                [default: 0.2]
+    -s          Save the results as a new baseline.
+    -h, --help  Prints this screen.
+
+"""
+import os
+import sys
+import gc
+import json
+import re
+import time
+import zlib
+import random
+import ctypes
+import ctypes.util
+from io import BytesIO
+from struct import Struct
+from docopt import docopt
+from PIL import Image
+import validator
+from panorama import Panorama
+
+try:
+    import tracemalloc          # python 3.4+ or pytracemalloc backport
+except ImportError:
+    tracemalloc = None
+
+# Allocation growth within page granularity is not a regression
+ALLOC_SLACK = 64*1024
+
+# Coordinates of the synthetic panorama and its id hash
+LATLNG = (50.0833, 14.4167)
+PANO_ID = 'bEnChMaRkPaNoRaMa00000'
+
+
+class FixturePanorama(Panorama):
+    """
+    Panorama serving its requests from fixture payloads
+    instead of the network.
+    """
+    def __init__(self, fixtures, pano_id=PANO_ID):
+        self.fixtures = fixtures
+        Panorama.__init__(self, pano_id=pano_id)
+
+    def requestData(self, url, query, headers=None):
+        if query.get('output') == 'tile':
+            key = (query['zoom'], query['x'], query['y'])
+            return self.fixtures['tiles'][key]
+        if 'pb' in query:
+            return self.fixtures['photometa']
+        return self.fixtures['meta']
+
+
+class RecordingPanorama(Panorama):
+    """
+    Panorama saving every received payload into a fixture directory.
+    """
+    def __init__(self, fdir, pano_id):
+        self.fdir = fdir
+        Panorama.__init__(self, pano_id=pano_id)
+
+    def requestData(self, url, query, headers=None):
+        msg = Panorama.requestData(self, url, query, headers)
+        if query.get('output') == 'tile':
+            fname = 'tile_%d_%d_%d.jpg' % (query['zoom'], query['x'], query['y'])
+        elif 'pb' in query:
+            fname = 'photometa.js'
+        else:
+            fname = 'meta.json'
+        with open(os.path.join(self.fdir, fname), 'wb') as f:
+            f.write(msg)
+        return msg
+
+
+def record(pano_id, fdir, zoom):
+    """
+    Records meta, time meta and image tiles of a panorama.
+    :param pano_id: string - panorama id hash
+    :param fdir: string - fixture directory
+    :param zoom: int [0-5] iterable - zoom levels
+    """
+    if not os.path.exists(fdir):
+        os.makedirs(fdir)
+    p = RecordingPanorama(fdir, pano_id)
+    if not p.isValid():
+        raise ValueError('Panorama %s not found' % pano_id)
+    for z in zoom:
+        if p.hasZoom(z):
+            p.getImage(z)
+
+
+def loadFixtures(fdir):
+    """
+    Loads payloads recorded by record().
+    :param fdir: string - fixture directory
+    :return: dictionary - payloads
+    """
+    fixtures = {'tiles': {}}
+    for fname in os.listdir(fdir):
+        with open(os.path.join(fdir, fname), 'rb') as f:
+            msg = f.read()
+        if fname.startswith('tile_'):
+            key = tuple(int(x) for x in fname[5:-4].split('_'))
+            fixtures['tiles'][key] = msg
+        elif fname == 'photometa.js':
+            fixtures['photometa'] = msg
+        elif fname == 'meta.json':
+            fixtures['meta'] = msg
+    return fixtures
+
+
+def syntheticDepthMap(width=512, height=256, n_planes=48):
+    """
+    Encodes a random depth map the same way the meta
+    'model.depth_map' field is encoded.
+    """
+    rnd = random.Random(0)
+    header = Struct('< B 3H B')
+    hsize = header.size
+    data = header.pack(hsize, n_planes, width, height, hsize)
+
+    # Horizontal bands of plane labels, ground planes at the bottom
+    lbls = bytearray(width * height)
+    for y in xrange(height):
+        row = bytearray(rnd.randrange(1, n_planes) for _ in xrange(width // 16))
+        lbls[y*width:(y+1)*width] = bytearray(b for b in row for _ in xrange(16))
+    data += bytes(lbls)
+
+    fmt = Struct('< 4f')
+    data += fmt.pack(0., 0., 0., 0.)            # plane 0, sky
+    for _ in xrange(n_planes - 1):
+        n = [rnd.uniform(-1, 1) for _ in range(3)]
+        data += fmt.pack(n[0], n[1], n[2], rnd.uniform(2, 50))
+
+    encoded = zlib.compress(data).encode('base64').replace('\n', '')
+    return encoded.replace('+', '-').replace('/', '_')
+
+
+def syntheticPhotometa(pano_id=PANO_ID, n_time=12, n_links=400):
+    """
+    Builds a photometa response with the structure expected by
+    getTemporalNeighbours(), sparse arrays included.
+    """
+    rnd = random.Random(0)
+    ids = ['%s%02d' % (pano_id[:20], j) for j in range(n_time)]
+    links = ','.join(
+        '[[2,"%s"],null,[[null,null,%.6f,%.6f]],,[%d,%d]]' % (
+            'x' * 22, LATLNG[0] + rnd.uniform(-.001, .001),
+            LATLNG[1] + rnd.uniform(-.001, .001), rnd.randrange(360), j)
+        for j in range(n_links - n_time)
+    )
+    links += ',' + ','.join('[[2,"%s"],,[]]' % x for x in ids)
+    tstamps = ','.join('[%d,[%d,%d]]' % (n_links - n_time + j, 2008 + j, j % 12 + 1)
+                       for j in range(n_time))
+    aux = '[1,,,[[%s]],,,,,[%s]]' % (links, tstamps)
+    body = '[[1],[[[2,"%s"],,,,,[,%s]]],,,[["en",,,"%s"]]]' % (pano_id, aux, 'y' * 2048)
+    return ")]}'\n" + body
+
+
+def regexParseTimeMeta(msg):
+    """
+    Former photometa parsing by regular expressions,
+    the reference of parseTimeMeta.
+    """
+    msg = re.match(r'.+\n(.+)', msg).groups()[0]
+    msg = re.sub(r'([\[,])(?=,)', r'\1null', msg)
+    return json.loads(msg)
+
+
+def syntheticFixtures(zoom):
+    """
+    Synthetic meta, time meta and image tiles payloads.
+    :param zoom: int [0-5] iterable - zoom levels
+    :return: dictionary - payloads
+    """
+    meta = {
+        'Data': {'image_date': '2015-06', 'copyright': '(C) 2015 Google'},
+        'Location': {'panoId': PANO_ID, 'zoomLevels': '5',
+                     'lat': str(LATLNG[0]), 'lng': str(LATLNG[1])},
+        'Links': [{'panoId': 'x' * 22, 'yawDeg': '90.0'}],
+        'model': {'depth_map': syntheticDepthMap()},
+    }
+
+    # Noisy tile does not compress too well, same as photos
+    rnd = random.Random(0)
+    img = Image.new('RGB', (512, 512))
+    img.putdata([(rnd.randrange(256), x % 256, y % 256)
+                 for y in range(512) for x in range(512)])
+    buf = BytesIO()
+    img.save(buf, 'JPEG')
+    tile = buf.getvalue()
+
+    p = Panorama()
+    tiles = {}
+    for z in zoom:
+        tw, th = p.numTiles(z)
+        for x in range(tw):
+            for y in range(th):
+                tiles[(z, x, y)] = tile
+
+    return {'meta': json.dumps(meta), 'photometa': syntheticPhotometa(),
+            'tiles': tiles}
+
+
+def peakRSS(fnc):
+    """
+    Peak growth of the resident memory during a function call, used
+    without tracemalloc. Free memory is returned to the system first
+    and the peak of /proc/self/status is reset, Linux only. Memory
+    of partly used Python arenas kept by the process is reused
+    without growth, small allocations are hence under-counted.
+    :param fnc: function without arguments
+    :return: int - peak allocation [bytes] or None if not available
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL(ctypes.util.find_library('c')).malloc_trim(0)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')                        # reset VmHWM to VmRSS
+        rss = procStatus()['VmRSS']
+    except (IOError, OSError, AttributeError, KeyError):
+        return None
+    fnc()
+    return (procStatus()['VmHWM'] - rss) * 1024
+
+
+def procStatus():
+    """ :return: dictionary - memory sizes of /proc/self/status [kB] """
+    status = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            key, val = line.split(':', 1)
+            if key.startswith('Vm'):
+                status[key] = int(val.split()[0])
+    return status
+
+
+def measure(fnc, n):
+    """
+    Measures time and allocated memory of a function call.
+    :param fnc: function without arguments
+    :param n: int - number of timed repetitions
+    :return: tuple - (best time [s], peak allocation [bytes] or None)
+    """
+    best = float('inf')
+    for _ in range(n):
+        gc.collect()
+        t = time.time()
+        fnc()
+        best = min(best, time.time() - t)
+
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+        fnc()
+        alloc = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        alloc = peakRSS(fnc)
+    return best, alloc
+
+
+def benchmarks(fixtures, zoom):
+    """
+    List of named benchmarks for given fixtures.
+    :return: list of tuples (name, function)
+    """
+    p = FixturePanorama(fixtures)
+    p.getDepthData()
+    msg = fixtures['photometa']
+
+    benches = [
+        ('getDepthData', p.getDepthData),
+        ('getTimeMeta', p.getTimeMeta),
+        ('parseTimeMeta', lambda: p.parseTimeMeta(msg)),
+        ('parseTimeMeta_regex', lambda: regexParseTimeMeta(msg)),
+        ('dumpTimeMeta', p.dumpTimeMeta),
+        ('dumpTimeMeta_json', lambda: json.dumps(p.time_meta)),
+        ('getTemporalNeighbours', p.getTemporalNeighbours),
+    ]
+    for z in zoom:
+        benches.append(('getDepthImg_zoom_%d' % z, lambda z=z: p.getDepthImg(z)))
+    for z in zoom:
+        benches.append(('getImage_zoom_%d' % z, lambda z=z: p.getImage(z)))
+
+    tiles = {}
+    for z in zoom:
+        tw, th = p.numTiles(z)
+        tiles[z] = [Image.open(BytesIO(fixtures['tiles'][(z, x, y)]))
+                    for x in range(tw) for y in range(th)]
+        benches.append(('stitchTiles_zoom_%d' % z,
+                        lambda z=z: p.stitchTiles(tiles[z], z)))
+
+    ll = p.getGPS()
+    for name, valid in [('circle', validator.circle(ll, 500)),
+                        ('box', validator.box(ll, 500, 500)),
+                        ('gpsbox', validator.gpsbox((ll[0]+.01, ll[1]-.01),
+                                                    (ll[0]-.01, ll[1]+.01)))]:
+        benches.append(('validator_%s' % name, lambda v=valid: v(p)))
+    return benches
+
+
+def run(fixtures, zoom, n, fbase, tol, save):
+    """
+    Runs benchmarks, prints the report and compares the results
+    with the baseline.
+    :return: int - number of regressions found
+    """
+    baseline = {}
+    if os.path.exists(fbase):
+        with open(fbase) as f:
+            baseline = json.load(f)
+
+    results = {}
+    n_reg = 0
+    print '%-28s %12s %12s %10s' % ('benchmark', 'time [ms]', 'alloc [kB]', 'vs base')
+    for name, fnc in benchmarks(fixtures, zoom):
+        t, alloc = measure(fnc, n)
+        results[name] = {'time': t, 'alloc': alloc}
+
+        cmp = ''
+        if name in baseline:
+            ratio = t / baseline[name]['time']
+            cmp = '%.2fx' % ratio
+            if ratio > 1 + tol:
+                cmp += ' SLOW'
+            base = baseline[name].get('alloc')
+            if alloc is not None and base is not None and \
+                    alloc > base * (1 + tol) + ALLOC_SLACK:
+                cmp += ' ALLOC'
+            if cmp.endswith(('SLOW', 'ALLOC')):
+                n_reg += 1
+        kb = '%12.1f' % (alloc / 1024.) if alloc is not None else '%12s' % '-'
+        print '%-28s %12.3f %s %10s' % (name, t*1000, kb, cmp)
+
+    if save:
+        with open(fbase, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print 'Baseline saved to ' + fbase
+    return n_reg
+
+
+def main():
+    args = docopt(__doc__)
+    zoom = map(lambda x: int(x), args['-z'].split(','))
+
+    if args['record']:
+        record(args['PID'], args['DIR'], zoom)
+        return
+
+    if args['-f']:
+        fixtures = loadFixtures(args['-f'])
+        zoom = [z for z in zoom if (z, 0, 0) in fixtures['tiles']]
+    else:
+        fixtures = syntheticFixtures(zoom)
+
+    n_reg = run(fixtures, zoom, int(args['-n']), args['-b'],
+                float(args['-T']), args['-s'])
+    if n_reg:
+        print '%d benchmark(s) slower or allocating more than the baseline' % n_reg
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
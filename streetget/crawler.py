@@ -2,9 +2,19 @@ import threading
 import os
 import logging
 import validator
-import shutil
-from panorama import Panorama
+import lookup
+import hosts
+import render
+import json
+from io import BytesIO
+from itertools import product
+from PIL import Image
+from panorama import Panorama, timegroups
 from database import Database
+from storage import FileStorage, ShardStorage, MetaStore, AsyncWriter, TileStore, WriteError
+from index import CrawlIndex, CellQuota
+from manifest import Manifest
+from graph import GraphWriter
 import time
 
 loger = logging.getLogger('crawler')
@@ -13,13 +23,19 @@ loger.setLevel(logging.DEBUG)
 class Crawler:
     t_save  = 600                # backup db every 10min
     n_thr   = 4                  # No. of crawling threads
+    buf_size = 256*1024**2       # write buffer 256MB
+    n_retry = 3                  # fetches of missing image tiles
+    n_attempts = 3               # attempts of a failed panorama per run
 
     def __init__(self,
                     latlng=None, pano_id=None, validator=None,
                     root='myData', label='myCity', zoom=5,
-                    images=False, depth=False, time=True
+                    images=False, depth=False, time=True,
+                    shard_size=None, compact=False, raw=False,
+                    seeds=None, grid=None, points=False, update=False,
+                    cube=None, sample=None, quota=1, checksum=False
                  ):
-        if not latlng and not pano_id:
+        if not latlng and not pano_id and not seeds and not grid:
             raise ValueError('start point (latlng or pano_id) not given')
 
         loger.info('___ Crawler starting ___')
@@ -33,23 +49,82 @@ class Crawler:
         self.start_latlng = latlng
         self.inArea = validator
 
-        self.db = Database()
+        self.db = Database(os.path.join(self.dir, 'frontier'))    # queue spilled to disk
+        self.inflight = None                    # shared fetches of the service jobs
         self.threads = self.n_thr * [None]      # thread vector allocation
         self.exit_flag = False                  # flag for signaling threads
 
         self.images = images
+        self.raw = raw
         self.depth = depth
+        self.points = points
+        self.cube = cube                        # cube map face size
+        # Sampling crawl, images and depth of quota panoramas per cell
+        self.quota = CellQuota(sample, quota) if sample else None
         self.time = time
+        timegroups.enabled = time               # siblings are not visited otherwise
 
         if not os.path.exists(self.dir):        # create dir
             os.makedirs(self.dir)
 
-        if os.path.exists(self.fname):          # resume existing crawler db
+        if shard_size:                          # tar shards or small files
+            storage = ShardStorage(self.dir, shard_size)
+        else:
+            storage = FileStorage(self.dir)
+        self.manifest = Manifest(self.dir)      # members completely written
+        if update:
+            # Missing or corrupt members are fetched again
+            bad = list(self.manifest.verify(storage, checksum))
+            for pano_id, member in bad:
+                self.manifest.discard(pano_id, member)
+            if bad:
+                print '%d saved files missing or corrupt, fetching them again' % len(bad)
+                loger.warn('%d members failed manifest verification' % len(bad))
+        self.storage = AsyncWriter(storage, self.buf_size, callback=self.manifest.add)
+        self.index = CrawlIndex(self.dir)
+        self.partial = TileStore(self.dir)      # tiles of unfinished images
+        self.graph = GraphWriter(self.dir)
+        self.metastore = MetaStore(self.dir, self.manifest.add) if compact else None
+
+        # Update crawls the area again, only missing files are fetched
+        if os.path.exists(self.fname) and not update:   # resume existing crawler db
             if not self.load(self.fname):
                 self.load(self.fname_bck)       # roll back to backup
+            # Panoramas given up in the last run are attempted again
+            for pano_id, n in self.db.f.items():
+                if n >= self.n_attempts:
+                    self.db.f[pano_id] = 0
+                    self.db.requeue(pano_id)
+            if self.quota:
+                for data in self.db.d.values():
+                    if data.get('sampled'):
+                        self.quota.add(data['latlng'])
         else:                                   # new  crawler db
-            p = Panorama(self.start_id, self.start_latlng)
-            self.db.enqueue(p.pano_id)          # starting panorama into a queue
+            if self.start_id or self.start_latlng:
+                p = Panorama(self.start_id, self.start_latlng)
+                self.db.enqueue(p.pano_id)      # starting panorama into a queue
+            self.seed(seeds, grid)
+
+    def seed(self, seeds=None, grid=None):
+        """
+        Fills the queue with additional starting panoramas, so that
+        street-graph components not connected to the starting point
+        are crawled too.
+        :param seeds: list of strings - pano_id hashes
+        :param grid: float - spacing in meters of a grid of points over
+                     the validator area, points are resolved to pano_ids
+        """
+        n = 0
+        for pano_id in seeds or []:
+            n += self.db.enqueue(pano_id)
+        if grid:
+            points = validator.grid(self.inArea, grid)
+            loger.info('resolving %d grid seeds' % len(points))
+            for _, pano_id in lookup.lookup(points, radius=max(15, grid/2)):
+                if pano_id:
+                    n += self.db.enqueue(pano_id)
+        if n:
+            loger.info('%d seed panoramas queued' % n)
 
     def save(self, fname):
         try:
@@ -71,18 +146,34 @@ class Crawler:
     
     def backup(self):
         loger.debug('Backup')
+        loger.info('Hosts:\n' + hosts.summary())
+        loger.info('Photometa requests saved by time machine groups: %d' % timegroups.n_saved)
         self.stopThreads()
         try:
-            self.save(self.fname)
-            shutil.copyfile(self.fname, self.fname_bck)
+            self.checkpoint()
         finally:
             self.startThreads()
 
-    def visitPano(self, p):
+    def checkpoint(self):
+        """
+        Flushes all outputs and saves the crawler db with
+        its backup. No panorama may be in progress.
+        """
+        self.flushStorage()
+        self.index.flush()
+        self.graph.flush()
+        if self.metastore:
+            self.metastore.flush()
+        self.manifest.flush()
+        self.save(self.fname)
+        self.db.copy(self.fname, self.fname_bck)
+
+    def visitPano(self, p, sampled=True):
         """
         Visits panorama, extracts meta data and adds
         info about panorama into database. Neighbour
         panoramas are added to the database queue.
+        :param sampled: boolean - images and depth were saved
         """
         if not (p and p.isValid() and self.inArea(p)):
             return
@@ -90,20 +181,25 @@ class Crawler:
         neighbours = p.getAllNeighbours() if self.time else p.getSpatialNeighbours()
         for n in neighbours:
             self.db.enqueue(n)            # update queue
+        self.graph.add(p.pano_id, p.getLinks(self.time))
 
         if p.isCustom():
             return                        # not Google panorama
 
         data = {'latlng': p.getGPS(), 'date': p.getDate()}
+        if self.quota:
+            data['sampled'] = sampled     # cell occupancy on resume
         self.db.add(p.pano_id, data)      # update visited db
         
     def savePano(self, p, zoom):
         """
         Saves panorama image at given zoom-level and its
-        metadata. Directory name corresponds to the first
-        two characters of the pano_id hash.
+        metadata into the crawler storage. In a sampling
+        crawl images and depth are saved only if the panorama
+        gets a place in its grid cell.
         :param p: Panorama - object
         :param zoom: int [0-5] iterable - zoom levels
+        :return: boolean - images and depth were saved
         """
         n_threads = 4
 
@@ -113,24 +209,191 @@ class Crawler:
         if p.isCustom():
             return          # not Google panorama
 
-        pdir = os.path.join(self.dir, '_' + p.pano_id[0:2])
-        pname = p.pano_id
-        pbase = os.path.join(pdir, pname)
+        # Depth payload is not kept twice
+        # Members already in the manifest are not fetched again
+        pid = p.pano_id
+        missing = lambda member: not self.has(pid, member)
+        if self.metastore:
+            if missing('meta.jsonl'):
+                meta = p.getMetaNoDepth() if self.depth else p.meta
+                self.metastore.add(pid, meta, p.time_meta)
+        else:
+            if missing('meta.json'):
+                self.storage.write(pid, 'meta.json', p.dumpMeta(not self.depth))
+            if missing('time_meta.json'):
+                self.storage.write(pid, 'time_meta.json', p.dumpTimeMeta())
+
+        sampled = not self.quota or self.quota.take(p.getGPS())
+
+        zsaved = []
+        if self.images and sampled:
+            ztop = max([z for z in zoom if p.hasZoom(z)] or [None])
+            for z in zoom:
+                if not p.hasZoom(z):
+                    continue
+                if self.raw:
+                    # Layout is written after all the tiles
+                    if missing('zoom_%d_layout.json' % z):
+                        self.saveTiles(p, z, n_threads)
+                else:
+                    self.saveImage(p, z, n_threads, self.cube and z == ztop)
+                zsaved.append(z)
+        dzoom = 0
+        if self.depth and sampled:
+            if missing('depth.json'):
+                self.storage.write(pid, 'depth.json', p.dumpDepthData())
+            if missing('zoom_0_depth.jpg'):
+                self.storage.write(pid, 'zoom_0_depth.jpg', p.dumpDepthImage(dzoom))
+        if self.points and sampled and missing('depth_points.ply'):
+            self.storage.write(pid, 'depth_points.ply', p.dumpPointCloud())
+
+        self.index.add(pid, p.getGPS(), p.getDate(), zsaved, self.depth and sampled)
+        return sampled
+
+    def saveImage(self, p, zoom, n_threads, cube=False):
+        """
+        Saves panorama image and optionally cube map faces rendered
+        from it. Members already in the manifest are skipped.
+        :param p: Panorama - object
+        :param zoom: int [0-5] - zoom level
+        :param cube: boolean - save cube map faces of size self.cube
+        """
+        pid = p.pano_id
+        name = 'zoom_%d.jpg' % zoom
+        image = not self.has(pid, name)
+        faces = [f for f in render.FACES
+                 if cube and not self.has(pid, render.cubeName(zoom, f))]
+        if not image and not faces:
+            return
+
+        tiles = self.fetchTiles(p, zoom, n_threads)
+        img = p.stitchTiles([Image.open(BytesIO(data)) for data in tiles], zoom)
+        if image:
+            self.storage.write(pid, name, render.encode(img))
+        if faces:
+            for face, face_img in render.cubemap(img, self.cube, faces).items():
+                self.storage.write(pid, render.cubeName(zoom, face), render.encode(face_img))
 
-        if not os.path.exists(pdir):
-            os.makedirs(pdir)
+    def saveTiles(self, p, zoom, n_threads):
+        """
+        Saves original JPEG tiles of the panorama, no decoding
+        nor re-encoding, and the layout needed to stitch them.
+        :param p: Panorama - object
+        :param zoom: int [0-5] - zoom level
+        """
+        layout = p.getLayout(zoom)
+        tiles = self.fetchTiles(p, zoom, n_threads)
+        th = layout['tiles'][1]
+        for j, data in enumerate(tiles):
+            x, y = j // th, j % th
+            self.storage.write(p.pano_id, layout['tile_name'].format(x=x, y=y), data)
+        self.storage.write(p.pano_id, 'zoom_%d_layout.json' % zoom, json.dumps(layout))
+
+    def has(self, pano_id, member):
+        """
+        Checks whether the member is saved already.
+        :return: boolean - member in the manifest
+        """
+        return self.manifest.has(pano_id, member)
 
-        p.saveMeta(pbase + '_meta.json')
-        p.saveTimeMeta(pbase + '_time_meta.json')
+    def fetchPano(self, pano_id):
+        """
+        Fetches panorama metadata. A key is queued only once, with
+        inflight set concurrent fetches of other crawlers are shared.
+        :return: Panorama - object
+        """
+        if self.inflight is None:
+            return Panorama(pano_id)
+        return self.inflight.fetch(pano_id, lambda: Panorama(pano_id))
 
+    def fetchTiles(self, p, zoom, n_threads):
+        """
+        Fetches raw image tiles of the panorama. Tiles are kept in
+        the partial tile store until the panorama is saved, tiles
+        found there are not fetched again. Missing tiles are
+        retried n_retry times.
+        :param p: Panorama - object
+        :param zoom: int [0-5] - zoom level
+        :return: list - JPEG strings, tile (x,y) at index y+th*x
+        """
+        tw, th = p.numTiles(zoom)
+        xys = list(product(range(tw), range(th)))
+        keep = len(xys) >= self.partial.n_min
+        tiles = [self.partial.read(p.pano_id, zoom, x, y) if keep else None
+                 for x, y in xys]
+
+        for _ in range(self.n_retry):
+            missing = [j for j, data in enumerate(tiles) if data is None]
+            if not missing:
+                break
+            fetched = p.getTilesData(zoom, n_threads, [xys[j] for j in missing])
+            for j, data in zip(missing, fetched):
+                if data is None:
+                    continue
+                tiles[j] = data
+                if keep:
+                    self.partial.write(p.pano_id, zoom, xys[j][0], xys[j][1], data)
+        else:
+            missing = [j for j, data in enumerate(tiles) if data is None]
+            if missing:
+                raise IOError('%s %d tiles of zoom %d not loaded' % (p.pano_id, len(missing), zoom))
+        return tiles
+
+    def process(self, pano_id):
+        """
+        Fetches, saves and visits a dequeued panorama,
+        db.task_done() is left to the caller.
+        :param pano_id: string - panorama id hash
+        """
+        if not self.db.visit(pano_id):
+            return                      # visited already
+        try:
+            p = self.fetchPano(pano_id)
+            sampled = self.savePano(p, self.zoom)
+        except Exception as e:
+            # Not visited, tiles fetched so far are kept for the next attempt
+            if isinstance(e, WriteError):
+                self.rewrite(e, pano_id)
+            self.retry(pano_id, e)
+            return
         if self.images:
-            for z in zoom:
-                if p.hasZoom(z):
-                    p.saveImage(pbase + '_zoom_' + str(z) + '.jpg', z, n_threads)
-        dzoom = 0
-        if self.depth:
-            p.saveDepthData(pbase+'_depth.json')
-            p.saveDepthImage(pbase+'_zoom_0_depth.jpg', dzoom)
+            self.partial.remove(pano_id)
+        self.visitPano(p, sampled)
+
+    def retry(self, pano_id, e):
+        """
+        Records a failed attempt of a panorama, it is queued again
+        unless attempted n_attempts times already.
+        :param e: Exception - cause of the failure
+        """
+        n = self.db.fail(pano_id)
+        loger.error('%s - %s: %s (attempt %d)' % (pano_id, type(e).__name__, str(e), n))
+        if n < self.n_attempts:
+            self.db.requeue(pano_id)
+
+    def rewrite(self, e, pano_id=None):
+        """
+        Panoramas whose members failed to be written are
+        visited again.
+        :param e: WriteError
+        :param pano_id: string - panorama retried by the caller
+        """
+        for pid in e.pano_ids:
+            if pid != pano_id:
+                self.db.unvisit(pid)
+                self.retry(pid, e)
+
+    def flushStorage(self, close=False):
+        """
+        Flushes or closes the storage, see rewrite().
+        """
+        try:
+            if close:
+                self.storage.close()
+            else:
+                self.storage.flush()
+        except WriteError as e:
+            self.rewrite(e)
 
     def worker(self):
         while not self.exit_flag:
@@ -138,10 +401,10 @@ class Crawler:
             if self.db.isSentinel(pano_id):
                 self.db.task_done()
                 return
-            p = Panorama(pano_id)
-            self.savePano(p, self.zoom)
-            self.visitPano(p)
-            self.db.task_done()
+            try:
+                self.process(pano_id)
+            finally:
+                self.db.task_done()
 
     def startThreads(self):
         self.exit_flag = False
@@ -162,9 +425,24 @@ class Crawler:
         print 'Sopping threads and saving.... please wait.'
         loger.debug('Exiting')
         self.stopThreads()
-        self.save(self.fname)
+        self.close()
         print 'Done'
 
+    def close(self):
+        """
+        Closes all outputs and saves the crawler db. No
+        panorama may be in progress.
+        """
+        self.flushStorage(close=True)
+        self.index.close()
+        self.graph.close()
+        if self.db.isCompleted():
+            self.partial.clear(keep=self.db.f)  # failed ones are kept
+        if self.metastore:
+            self.metastore.close()
+        self.manifest.close()
+        self.save(self.fname)
+
     def run(self):
         """
         Performs parallel BFS crawling. Main threads perform crawling via BFS.
@@ -173,7 +451,7 @@ class Crawler:
         state at KeyboardInterrupt is handled.
         """
         self.startThreads()
-        monitor = Monitor(self.db)
+        monitor = Monitor(self.db, self.inflight)
         backuper = Backuper(self.backup, self.t_save)
 
         try:
@@ -193,8 +471,9 @@ class Crawler:
             self.onexit()
 
 class Monitor:
-    def __init__(self, db):
+    def __init__(self, db, inflight=None):
         self.db = db
+        self.inflight = inflight
         self.t0 = time.time()
         self.n0 = db.dsize()
         self.tl = self.t0
@@ -207,8 +486,9 @@ class Monitor:
         avg = (n - self.n0)/(t - self.t0)*60
         v = (n - self.nl)/(t - self.tl)*60
 
-        print 'DB size: %06d\t Q size: %05d\t %05d/min\t avg %05d/min' % \
-              (n, self.db.qsize(), v, avg)
+        n_shared = self.inflight.n_shared if self.inflight else 0
+        print 'DB size: %06d\t Q size: %05d\t %05d/min\t avg %05d/min\t dup: %d shared: %d tm saved: %d' % \
+              (n, self.db.qsize(), v, avg, self.db.n_dup, n_shared, timegroups.n_saved)
 
         self.tl = t
         self.nl = n
@@ -1,14 +1,21 @@
+import os
+import json
 import Queue
+import shutil
+from collections import deque
 import pickle
 import logging
+import threading
 
 loger = logging.getLogger(__name__)
 loger.setLevel(logging.WARNING)
 
 class Dbdata:
     qvec = []
+    qstate = None               # SpillQueue state, qvec is empty then
     d = dict()
     s = set()
+    f = dict()                  # failed attempts of keys not visited
     active = 0
 
 '''
@@ -19,12 +26,202 @@ class Sentinel:
     pass
 
 
-class Database:
+class InFlight:
+    """
+    Registry of fetches in progress. Concurrent fetches of
+    the same key share the result of a single call.
+    """
     def __init__(self):
-        self.q = Queue.Queue()
+        self.lock = threading.Lock()
+        self.calls = dict()             # {key: [event, result, error]}
+        self.n_shared = 0               # fetches served by another call
+
+    def fetch(self, key, fnc):
+        """
+        Calls fnc() unless a call for the key is in progress,
+        then it waits for its result.
+        :param key: hashable - e.g. pano_id
+        :param fnc: function without arguments
+        :return: result of fnc()
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            owner = call is None
+            if owner:
+                call = self.calls[key] = [threading.Event(), None, None]
+            else:
+                self.n_shared += 1
+
+        if not owner:
+            call[0].wait()
+            if call[2]:
+                raise call[2]
+            return call[1]
+
+        try:
+            call[1] = fnc()
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call[0].set()
+        return call[1]
+
+
+class SpillQueue(Queue.Queue):
+    """
+    FIFO queue of keys held in memory only at its ends. The head is
+    the deque self.queue (sentinels may be prepended), when the tail
+    reaches seg_size keys it is spilled into a segment file
+    DIR/seg_NNNNNN.txt, one key per line. Segments are read back
+    in order when the head is empty, the next segment is prefetched
+    in the background meanwhile. Memory is bounded by about
+    4*seg_size keys however long the queue is.
+    """
+    seg_size = 10000
+
+    def __init__(self, root):
+        self.dir = root
+        if not os.path.exists(root):
+            os.makedirs(root)
+        Queue.Queue.__init__(self)
+
+    def _init(self, maxsize):
+        self.queue = deque()                # head
+        self.tail = deque()
+        self.segs = deque()                 # spilled [(fname, # keys)]
+        self.n_spilled = 0
+        self.n_seg = 0                      # segment counter
+        self.prefetched = None              # [fname, keys, thread]
+
+    def _qsize(self, len=len):
+        return len(self.queue) + self.n_spilled + len(self.tail)
+
+    def _put(self, item):
+        if not self.segs and not self.tail and len(self.queue) < self.seg_size:
+            self.queue.append(item)
+            return
+        self.tail.append(item)
+        if len(self.tail) >= self.seg_size:
+            self.spill()
+
+    def _get(self):
+        if not self.queue:
+            if self.segs:
+                self.unspill()
+            else:
+                self.queue, self.tail = self.tail, self.queue
+        return self.queue.popleft()
+
+    def spill(self):
+        fname = os.path.join(self.dir, 'seg_%06d.txt' % self.n_seg)
+        with open(fname, 'w') as f:
+            f.write('\n'.join(self.tail))
+        self.segs.append((fname, len(self.tail)))
+        self.n_spilled += len(self.tail)
+        self.n_seg += 1
+        self.tail = deque()
+
+    def unspill(self):
+        # The file is removed by commit() once no saved state needs it
+        fname, n = self.segs.popleft()
+        item = self.prefetched
+        self.prefetched = None
+        keys = None
+        if item and item[0] == fname:
+            item[2].join()
+            keys = item[1]
+        if keys is None:
+            keys = self.read(fname)
+        self.queue.extend(keys)
+        self.n_spilled -= n
+        if self.segs:
+            self.prefetch(self.segs[0][0])
+
+    def read(self, fname):
+        with open(fname) as f:
+            return f.read().split('\n')
+
+    def prefetch(self, fname):
+        """ Reads the segment in a thread, unspill() takes it over """
+        item = [fname, None, None]
+
+        def load():
+            try:
+                item[1] = self.read(fname)
+            except (IOError, OSError):
+                item[1] = None
+
+        item[2] = threading.Thread(target=load)
+        item[2].setDaemon(True)
+        item[2].start()
+        self.prefetched = item
+
+    def first(self):
+        """ Number of the oldest segment the queue needs """
+        with self.mutex:
+            if self.segs:
+                return int(os.path.basename(self.segs[0][0])[4:10])
+            return self.n_seg
+
+    def state(self):
+        """
+        Queue state to be pickled, spilled keys stay in their files.
+        :return: dictionary
+        """
+        with self.mutex:
+            return {
+                'head':     list(self.queue),
+                'tail':     list(self.tail),
+                'segs':     [os.path.basename(fname) for fname, n in self.segs],
+                'n_segs':   [n for fname, n in self.segs],
+                'n_seg':    self.n_seg,
+            }
+
+    def restore(self, state):
+        with self.mutex:
+            self.queue = deque(state['head'])
+            self.tail = deque(state['tail'])
+            self.segs = deque((os.path.join(self.dir, fname), n)
+                                    for fname, n in zip(state['segs'], state['n_segs']))
+            self.n_spilled = sum(state['n_segs'])
+            self.n_seg = state['n_seg']
+            self.prefetched = None
+            self.unfinished_tasks = self._qsize()
+
+    def commit(self, first):
+        """
+        Removes segment files older than segment number first, call
+        it after the queue state was saved. Segments are consumed in
+        order, so states saved earlier need only segments from their
+        own first segment on.
+        :param first: int - oldest segment any saved state needs
+        """
+        for fname in os.listdir(self.dir):
+            if fname.startswith('seg_') and int(fname[4:10]) < first:
+                os.remove(os.path.join(self.dir, fname))
+
+
+class Database:
+    def __init__(self, spill_dir=None):
+        """
+        :param spill_dir: string - directory of the queue spilled to
+                          disk, the queue is kept in memory if unset
+        """
+        self.spill_dir = spill_dir
+        self.refs = dict()              # {db file: its oldest segment}
+        self.q = self.newQueue()
         self.d = dict()
         self.s = set()
+        self.f = dict()                 # {key: # failed attempts}
         self.active = 0
+        self.n_dup = 0                  # duplicate visits
+        self.lock = threading.Lock()
+
+    def newQueue(self):
+        return SpillQueue(self.spill_dir) if self.spill_dir else Queue.Queue()
 
     def prependSentinel(self):
         self.q.not_empty.acquire()
@@ -40,17 +237,60 @@ class Database:
         return isinstance(key, Sentinel)
 
     def enqueue(self, key):
-        if key not in self.s:
+        """
+        Atomic check-and-enqueue, a key is queued only once.
+        :return: boolean - True if the key was queued
+        """
+        with self.lock:
+            if key in self.s:
+                return False
             self.s.add(key)
-            self.q.put(key)
+        self.q.put(key)
+        return True
 
-    def dequeue(self):
-        item = self.q.get()
+    def visit(self, key):
+        """
+        Checks that a dequeued key was not visited yet, keys
+        visited already are counted as duplicate work.
+        :return: boolean - True if the key is to be processed
+        """
+        with self.lock:
+            if key in self.d:
+                self.n_dup += 1
+                return False
+        return True
+
+    def dequeue(self, block=True):
+        """
+        :param block: boolean - wait for a key, else Queue.Empty
+                      is raised if there is none
+        """
+        item = self.q.get(block)
         with self.q.mutex:
             self.active += 1
         return item
 
+    def unvisit(self, key):
+        """ Forgets a visited key, e.g. its outputs were lost """
+        with self.lock:
+            self.d.pop(key, None)
+
+    def requeue(self, key):
+        """ Queues a key again, e.g. after a failed attempt """
+        self.q.put(key)
+
+    def fail(self, key):
+        """
+        Records a failed attempt of a key.
+        :return: int - number of failed attempts
+        """
+        with self.lock:
+            n = self.f[key] = self.f.get(key, 0) + 1
+        return n
+
     def add(self, key, val):
+        with self.lock:
+            self.f.pop(key, None)
         self.d[key] = val
 
     def has(self, key):
@@ -86,11 +326,37 @@ class Database:
         dbdata = Dbdata()
         dbdata.d = self.d
         dbdata.s = self.s
+        dbdata.f = self.f
         dbdata.active = self.active
-        dbdata.qvec = self.q.queue
+        if isinstance(self.q, SpillQueue):
+            dbdata.qstate = self.q.state()
+        else:
+            dbdata.qvec = self.q.queue
 
         with open(fname, 'w') as f:
             pickle.dump(dbdata, f)
+        if isinstance(self.q, SpillQueue):
+            self.refs[os.path.basename(fname)] = self.q.first()
+            self.commitRefs()
+
+    def copy(self, fname, fname_bck):
+        """
+        Copies a saved db file, e.g. to its backup. Segments of the
+        spilled queue are kept while any of the copies needs them.
+        """
+        shutil.copyfile(fname, fname_bck)
+        src = os.path.basename(fname)
+        if isinstance(self.q, SpillQueue) and src in self.refs:
+            self.refs[os.path.basename(fname_bck)] = self.refs[src]
+            self.commitRefs()
+
+    def commitRefs(self):
+        # References are kept in the spill directory for resumes
+        fname = os.path.join(self.spill_dir, 'refs.json')
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(self.refs, f)
+        os.rename(fname + '.tmp', fname)
+        self.q.commit(min(self.refs.values()))
 
     def load(self, fname):
         with open(fname) as f:
@@ -98,7 +364,15 @@ class Database:
 
         self.d = dbdata.d
         self.s = dbdata.s
+        self.f = dict(dbdata.f)
         self.active = dbdata.active
-        self.q = Queue.Queue()
+        self.q = self.newQueue()
+        self.refs = dict()
+        fname = os.path.join(self.spill_dir or '', 'refs.json')
+        if self.spill_dir and os.path.exists(fname):
+            with open(fname) as f:
+                self.refs = json.load(f)
+        if dbdata.qstate:
+            self.q.restore(dbdata.qstate)
         for item in dbdata.qvec:
             self.q.put(item)
@@ -0,0 +1,149 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+'''
+Vectorized computations over depth data returned by
+Panorama.getDepthData(): depth maps and 3D point clouds.
+Depth data are a tuple ((width, height), labels, planes).
+'''
+
+_rays = OrderedDict()               # {(width, height): rays}
+_lock = threading.Lock()
+n_rays = 8                          # max. number of cached ray arrays
+rays_bytes = 256 * 1024**2          # max. bytes of cached rays
+
+
+def rays(w, h):
+    """
+    Unit rays from the camera center for every pixel of the w x h
+    spherical panorama. Rays are cached per size, the least
+    recently used are dropped beyond n_rays arrays or rays_bytes,
+    larger arrays are not cached. Do not modify.
+    :param w: int - width
+    :param h: int - height
+    :return: numpy array h x w x 3
+    """
+    key = (w, h)
+    with _lock:
+        if key in _rays:
+            v = _rays[key] = _rays.pop(key)
+            return v
+
+    pi = np.pi
+    y, x = np.indices((h, w))           # grid of coordinates
+    offset = pi/2                       # no idea why not pi,
+    yaw = (w-1 - x) * 2*pi / (w-1) + offset
+    pitch = (h-1 - y) * pi / (h-1)      # 0 down, pi/2 horizontal, pi up
+
+    # Rays from spherical to cartesian
+    v = np.array([
+        np.sin(pitch) * np.cos(yaw),
+        np.sin(pitch) * np.sin(yaw),
+        np.cos(pitch)
+    ])
+    v = v.transpose(1, 2, 0)
+    v.flags.writeable = False
+
+    if v.nbytes > rays_bytes:
+        return v
+    with _lock:
+        _rays[key] = v
+        while len(_rays) > n_rays or sum(x.nbytes for x in _rays.values()) > rays_bytes:
+            _rays.popitem(last=False)
+    return v
+
+
+def labels(depthdata, size=None):
+    """
+    Plane labels as a 2D array, optionally resampled (nearest
+    neighbour) to a different size.
+    :param depthdata: tuple - data from getDepthData()
+    :param size: tuple (width, height) or None
+    :return: numpy array h x w
+    """
+    (w, h), lbls, _ = depthdata
+    lbls = np.asarray(lbls, dtype=np.uint8).reshape((h, w))
+    if size and size != (w, h):
+        W, H = size
+        ys = np.arange(H) * h // H
+        xs = np.arange(W) * w // W
+        lbls = lbls[ys[:, None], xs[None, :]]
+    return lbls
+
+
+def depthMap(depthdata, size=None):
+    """
+    Distance from the camera center of every pixel, the intersection
+    of pixel ray with its plane. Pixels without plane are NaN.
+    :param depthdata: tuple - data from getDepthData()
+    :param size: tuple (width, height) or None for the native size
+    :return: numpy array h x w
+    """
+    _, _, planes = depthdata
+    lbls = labels(depthdata, size)
+    h, w = lbls.shape
+
+    normals = np.array([p[0] for p in planes], dtype=np.float64).reshape((-1, 3))
+    dists = np.array([p[1] for p in planes], dtype=np.float64)
+    dists[dists == 0] = np.nan
+
+    # w x h x 3 normal, resp. w x h x 1 distance
+    n = normals[lbls]
+    d = dists[lbls]
+
+    # distance from camera center, ray intersection with plane
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return d / np.abs(np.einsum('ijk,ijk->ij', rays(w, h), n))
+
+
+def pointCloud(depthdata, size=None, step=1):
+    """
+    3D points of the depth map in the camera frame.
+    :param depthdata: tuple - data from getDepthData()
+    :param size: tuple (width, height) or None for the native size
+    :param step: int - subsampling, every step-th pixel in both directions
+    :return: numpy float32 array N x 3 - XYZ, pixels without depth dropped
+    """
+    dmap = depthMap(depthdata, size)
+    h, w = dmap.shape
+    v = rays(w, h)
+    if step > 1:
+        dmap = dmap[::step, ::step]
+        v = v[::step, ::step]
+
+    valid = np.isfinite(dmap)
+    return (v[valid] * dmap[valid][:, None]).astype(np.float32)
+
+
+def dumpPly(points):
+    """
+    Encodes a point cloud as binary little endian PLY.
+    :param points: numpy array N x 3
+    :return: string - PLY data
+    """
+    header = 'ply\n' \
+             'format binary_little_endian 1.0\n' \
+             'element vertex %d\n' \
+             'property float x\n' \
+             'property float y\n' \
+             'property float z\n' \
+             'end_header\n' % len(points)
+    return header + np.ascontiguousarray(points, dtype='<f4').tobytes()
+
+
+def pointClouds(panos, zoom=None, step=1):
+    """
+    Point clouds of a batch of panoramas. Panoramas of the same
+    size share cached rays.
+    :param panos: iterable of Panorama objects with depth data
+    :param zoom: int [0-5] - resolution of the panorama image at given
+                 zoom level, None for the native depth map size
+    :param step: int - subsampling
+    :return: generator of tuples (pano_id, numpy array N x 3)
+    """
+    for p in panos:
+        if not p.depthdata:
+            p.getDepthData()
+        size = p.cropSize(zoom)[2:] if zoom is not None else None
+        yield p.pano_id, pointCloud(p.depthdata, size, step)
@@ -0,0 +1,247 @@
+import random
+import threading
+import logging
+from math import pi, cos, sqrt
+import validator
+import hosts
+from panorama import Panorama
+
+loger = logging.getLogger('estimate')
+loger.setLevel(logging.WARNING)
+
+'''
+Pre-crawl cost estimate of an area. Random points of the area are
+resolved to panoramas and panoramas within radius R of each point are
+counted by a small local crawl. The mean count over all points divided
+by the disk area pi R^2 is the panorama density of the area (a point
+without any panorama within R counts 0). Sizes of outputs are measured
+on the sampled panoramas, image sizes from one center tile per zoom.
+'''
+M_PER_DEG = 111320.0
+
+
+def requests(endpoints=None):
+    """
+    Number of requests sent so far.
+    :param endpoints: string iterable - host pools, default all
+    :return: int
+    """
+    return sum(n_ok + n_err for name, pool in hosts.pools.items()
+               if endpoints is None or name in endpoints
+               for _, _, n_ok, n_err in pool.stats())
+
+
+def area(pvalid, n=20000):
+    """
+    Monte Carlo estimate of the validator area.
+    :return: float - area [m^2]
+    """
+    (lt0, ln0), (lt1, ln1) = pvalid.bbox
+    w = (ln1 - ln0) * M_PER_DEG * cos((lt0 + lt1) / 2 * pi / 180)
+    h = (lt0 - lt1) * M_PER_DEG
+    rnd = random.Random(0)
+    pts = [validator.Point((rnd.uniform(lt1, lt0), rnd.uniform(ln0, ln1))) for _ in range(n)]
+    return w * h * sum(1 for pt in pts if pvalid(pt)) / float(n)
+
+
+def randomPoint(pvalid, rnd):
+    (lt0, ln0), (lt1, ln1) = pvalid.bbox
+    while True:
+        ll = (rnd.uniform(lt1, lt0), rnd.uniform(ln0, ln1))
+        if pvalid(validator.Point(ll)):
+            return ll
+
+
+class Estimate:
+    """
+    Samples the area within a budget of requests. Requests in
+    progress when the budget runs out are finished, so the budget
+    may be exceeded by a few requests per thread.
+    """
+    n_img_max = 3               # panoramas sampled for image sizes
+
+    def __init__(self, pvalid, zoom=(), depth=False, time=False, budget=500,
+                 n_threads=16, radius=50, seed=None):
+        """
+        :param pvalid: validator - area, see validator.circle()
+        :param zoom: int iterable - zoom levels of images to be saved
+        :param depth: boolean - depth data to be saved
+        :param time: boolean - temporal neighbours to be crawled
+        :param budget: int - max. number of requests
+        :param radius: float - R of sample disks [m]
+        """
+        self.pvalid = pvalid
+        self.zoom = list(zoom)
+        self.depth = depth
+        self.time = time
+        self.radius = radius
+        self.n_threads = n_threads
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.r0 = requests()
+        self.m0 = requests(('meta', 'photometa'))
+        self.limit = self.r0 + budget
+        self.counts = []            # panoramas per sample disk
+        self.sizes = []             # [(meta, time meta, depth)] of panoramas
+        self.tiles = dict()         # {zoom: [center tile size]}
+        self.n_pano = 0             # panoramas fetched
+        self.n_img = 0              # panoramas of image sizes
+
+    def spent(self):
+        return requests() >= self.limit
+
+    def sample(self, latlng):
+        """
+        Counts panoramas within radius around latlng. Panoramas up
+        to 2*radius away are crawled, the disk may be reached through
+        them.
+        :return: int - count or None if the budget ran out
+        """
+        pano_id = Panorama().getPanoID(latlng, self.radius)
+        if not pano_id:
+            return 0
+
+        inner = validator.circle(latlng, self.radius)
+        outer = validator.circle(latlng, 2 * self.radius)
+        seen, queue, n = set([pano_id]), [pano_id], 0
+        while queue:
+            if self.spent():
+                return None
+            p = Panorama(queue.pop())
+            with self.lock:
+                self.n_pano += 1
+            if not (p.isValid() and outer(p)):
+                continue
+            self.measure(p)
+            if inner(p):
+                n += 1
+            links = p.getAllNeighbours() if self.time else p.getSpatialNeighbours()
+            for pid in links:
+                if pid not in seen:
+                    seen.add(pid)
+                    queue.append(pid)
+        return n
+
+    def measure(self, p):
+        sizes = (len(p.dumpMeta(not self.depth)), len(p.dumpTimeMeta()),
+                 len(p.dumpDepthData()) + len(p.dumpDepthImage(0)) if self.depth else 0)
+        with self.lock:
+            self.sizes.append(sizes)
+            if not self.zoom or self.n_img >= self.n_img_max:
+                return
+            self.n_img += 1
+        for z in self.zoom:
+            if p.hasZoom(z):
+                tw, th = p.numTiles(z)
+                data = p.getTileData(tw // 2, th // 2, z)
+                if data:
+                    with self.lock:
+                        self.tiles.setdefault(z, []).append(len(data))
+
+    def worker(self):
+        while not self.spent():
+            with self.lock:
+                latlng = randomPoint(self.pvalid, self.rnd)
+            try:
+                n = self.sample(latlng)
+            except Exception as e:
+                loger.error('%s - %s: %s' % (latlng, type(e).__name__, str(e)))
+                continue
+            if n is not None:           # truncated samples are biased
+                with self.lock:
+                    self.counts.append(n)
+
+    def run(self):
+        """
+        :return: dictionary - see report()
+        """
+        threads = [threading.Thread(target=self.worker) for _ in range(self.n_threads)]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+        return self.result()
+
+    def result(self):
+        n = len(self.counts)
+        if not n:
+            raise ValueError('No sample finished, increase the request budget')
+        a = area(self.pvalid)
+        disk = pi * self.radius ** 2
+        mean = sum(self.counts) / float(n)
+        var = sum((c - mean) ** 2 for c in self.counts) / max(n - 1, 1)
+        n_pano = a * mean / disk
+        err = a * sqrt(var / n) / disk
+
+        # Requests and bytes per panorama
+        p = Panorama()
+        k = max(len(self.sizes), 1)
+        n_meta = requests(('meta', 'photometa')) - self.m0
+        per_pano = {
+            'requests':     float(n_meta) / max(self.n_pano, 1),
+            'meta':         sum(s[0] for s in self.sizes) / float(k),
+            'time_meta':    sum(s[1] for s in self.sizes) / float(k),
+            'depth':        sum(s[2] for s in self.sizes) / float(k),
+        }
+        zooms = dict()
+        for z in self.zoom:
+            tw, th = p.numTiles(z)
+            _, _, w, h = p.cropSize(z)
+            tiles = self.tiles.get(z)
+            size = sum(tiles) / float(len(tiles)) * w * h / 512.0**2 if tiles else None
+            zooms[z] = {'requests': tw * th, 'bytes': size}
+
+        return {
+            'area':         a,
+            'samples':      n,
+            'hits':         sum(1 for c in self.counts if c),
+            'density':      mean / disk,
+            'panoramas':    n_pano,
+            'error':        err,
+            'per_pano':     per_pano,
+            'zooms':        zooms,
+            'spent':        requests() - self.r0,
+        }
+
+
+def estimate(pvalid, zoom=(), depth=False, time=False, budget=500, n_threads=16,
+             radius=50):
+    """
+    Estimates panoramas, requests and storage of crawling the area.
+    :return: dictionary - see report()
+    """
+    return Estimate(pvalid, zoom, depth, time, budget, n_threads, radius).run()
+
+
+def report(res):
+    """
+    Printable report of estimate() results.
+    :return: string
+    """
+    mb = lambda x: x / 1024.0**2
+    n = res['panoramas']
+    pp = res['per_pano']
+    lines = [
+        'Area:                 %.3f km2' % (res['area'] / 1e6),
+        'Samples:              %d (%d with panoramas)' % (res['samples'], res['hits']),
+        'Requests spent:       %d' % res['spent'],
+        'Density:              %.1f panoramas/km2' % (res['density'] * 1e6),
+        'Panoramas:            %d +- %d' % (n, res['error']),
+        '',
+        '%-20s %14s %14s' % ('', 'requests', 'storage [MB]'),
+        '%-20s %14d %14.1f' % ('metadata', n * pp['requests'],
+                               mb(n * (pp['meta'] + pp['time_meta']))),
+    ]
+    total_req = n * pp['requests']
+    total_size = n * (pp['meta'] + pp['time_meta'] + pp['depth'])
+    if pp['depth']:
+        lines.append('%-20s %14d %14.1f' % ('depth', 0, mb(n * pp['depth'])))
+    for z in sorted(res['zooms']):
+        item = res['zooms'][z]
+        size = mb(n * item['bytes']) if item['bytes'] is not None else float('nan')
+        lines.append('%-20s %14d %14.1f' % ('zoom %d' % z, n * item['requests'], size))
+        total_req += n * item['requests']
+        total_size += n * (item['bytes'] or 0)
+    lines.append('%-20s %14d %14.1f' % ('total', total_req, mb(total_size)))
+    return '\n'.join(lines)
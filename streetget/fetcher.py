@@ -0,0 +1,175 @@
+import threading
+import logging
+from Queue import Queue
+from io import BytesIO
+from PIL import Image
+from panorama import Panorama
+import depth
+
+loger = logging.getLogger('fetcher')
+loger.setLevel(logging.WARNING)
+
+'''
+Non-blocking counterparts of the Panorama fetching methods. Calls
+return a Future immediately, the work is done by a pool of threads
+sharing the HTTP connection pool of panorama.session.
+'''
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Future:
+    """
+    Result of a fetch that is possibly not finished yet.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.finished = False
+        self.cancelled = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def set(self, value=None, error=None):
+        """ Finishes the future, the first call wins """
+        with self.cond:
+            if self.finished:
+                return False
+            self.finished = True
+            self.value, self.error = value, error
+            callbacks, self.callbacks = self.callbacks, []
+            self.cond.notify_all()
+        for fnc in callbacks:
+            fnc(self)
+        return True
+
+    def cancel(self):
+        """
+        Cancels the fetch, its requests not sent yet are dropped.
+        :return: boolean - False if the fetch was already finished
+        """
+        with self.cond:
+            if self.finished:
+                return False
+            self.cancelled = True
+        return self.set(error=Cancelled())
+
+    def done(self):
+        return self.finished
+
+    def result(self, timeout=None):
+        """
+        Waits for the result.
+        :param timeout: float - seconds, None waits forever
+        :return: fetched value, raises the error of the fetch
+        """
+        with self.cond:
+            if not self.finished:
+                self.cond.wait(timeout)
+            if not self.finished:
+                raise RuntimeError('Fetch not finished within %s s' % timeout)
+        if self.error:
+            raise self.error
+        return self.value
+
+    def addCallback(self, fnc):
+        """ Calls fnc(future) when finished """
+        with self.cond:
+            if not self.finished:
+                self.callbacks.append(fnc)
+                return
+        fnc(self)
+
+
+class Fetcher:
+    """
+    Pool of threads fetching panoramas, images and depth. Image
+    tiles are fetched as separate concurrent requests.
+    """
+    def __init__(self, n_threads=32):
+        self.q = Queue()
+        self.threads = []
+        for _ in range(n_threads):
+            t = threading.Thread(target=self.worker)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def worker(self):
+        while True:
+            item = self.q.get()
+            if item is None:
+                return
+            fut, fnc = item
+            if not fut.done():                  # cancelled or failed
+                try:
+                    fnc()
+                except Exception as e:
+                    fut.set(error=e)
+
+    def submit(self, fnc):
+        """
+        Runs fnc() in the pool.
+        :return: Future - result of fnc()
+        """
+        fut = Future()
+        self.q.put((fut, lambda: fut.set(fnc())))
+        return fut
+
+    def panorama(self, pano_id=None, latlng=None, radius=15):
+        """
+        Panorama with metadata by pano_id or the closest one to latlng.
+        :return: Future - Panorama
+        """
+        return self.submit(lambda: Panorama(pano_id, latlng, radius))
+
+    def image(self, p, zoom=5):
+        """
+        Panorama image, tiles are requested concurrently and
+        stitched when all of them arrived.
+        :param p: Panorama - object with metadata
+        :param zoom: int [0-5] - zoom level
+        :return: Future - Image
+        """
+        fut = Future()
+        tw, th = p.numTiles(zoom)
+        tiles = tw*th*[None]
+        left = [tw*th]
+        lock = threading.Lock()
+
+        def tile(x, y):
+            msg = p.getTileData(x, y, zoom)
+            if msg is None:
+                raise IOError('%s tile %d %d not loaded' % (p.pano_id, x, y))
+            with lock:
+                tiles[y+th*x] = msg
+                left[0] -= 1
+                last = left[0] == 0
+            if last and not fut.cancelled:
+                imgs = [Image.open(BytesIO(data)) for data in tiles]
+                fut.set(p.stitchTiles(imgs, zoom))
+
+        for x in range(tw):
+            for y in range(th):
+                self.q.put((fut, lambda x=x, y=y: tile(x, y)))
+        return fut
+
+    def depth(self, p):
+        """
+        Depth data and depth map of the panorama.
+        :param p: Panorama - object with metadata
+        :return: Future - tuple (depthdata, depthmap)
+        """
+        def fnc():
+            p.getDepthData()
+            p.depthmap = depth.depthMap(p.depthdata)
+            return p.depthdata, p.depthmap
+        return self.submit(fnc)
+
+    def close(self):
+        for _ in self.threads:
+            self.q.put(None)
+        for t in self.threads:
+            t.join()
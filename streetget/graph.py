@@ -0,0 +1,195 @@
+import os
+import threading
+import numpy as np
+
+'''
+Street graph of a crawl. Edges are logged while panoramas are
+visited, DIR/graph/nodes.txt maps node ids (line numbers) to
+pano_ids and DIR/graph/edges.bin holds raw edge records. When the
+crawl ends the log is compacted into CSR adjacency arrays, raw
+little endian files that are memory-mapped by load():
+indptr.bin  - node j edges are at [indptr[j], indptr[j+1])
+indices.bin - target node ids
+etype.bin   - SPATIAL or TEMPORAL
+yaw.bin     - compass heading of spatial edges [deg], NaN if unknown
+'''
+EDGE = np.dtype([('src', '<i4'), ('dst', '<i4'), ('etype', 'u1'), ('yaw', '<f4')])
+CSR = [
+    ('indptr',  '<i8'),
+    ('indices', '<i4'),
+    ('etype',   'u1'),
+    ('yaw',     '<f4'),
+]
+
+SPATIAL = 0
+TEMPORAL = 1
+
+
+class GraphWriter:
+    """
+    Logs edges of visited panoramas. Edges are buffered and
+    written in batches of n_buf edges.
+    """
+    n_buf = 4096
+
+    def __init__(self, root):
+        self.root = root
+        self.dir = os.path.join(root, 'graph')
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        self.fnodes = os.path.join(self.dir, 'nodes.txt')
+        self.fedges = os.path.join(self.dir, 'edges.bin')
+        self.lock = threading.Lock()
+        self.ids = dict()               # {pano_id: node id}
+        self.nodes = []                 # new pano_ids not written yet
+        self.edges = []
+        self.load()
+
+    def load(self):
+        """ Node ids of a resumed crawl, edges to unknown nodes are dropped """
+        if os.path.exists(self.fnodes):
+            nodes = []
+            with open(self.fnodes) as f:
+                for line in f:
+                    nodes.append(line)
+            if nodes and not nodes[-1].endswith('\n'):    # interrupted write
+                nodes.pop()
+                with open(self.fnodes, 'w') as f:
+                    f.write(''.join(nodes))
+            self.ids = dict((line[:-1], j) for j, line in enumerate(nodes))
+        else:
+            open(self.fnodes, 'w').close()
+
+        if os.path.exists(self.fedges):
+            edges = np.fromfile(self.fedges, EDGE)
+            n = len(self.ids)
+            ok = (edges['src'] < n) & (edges['dst'] < n)
+            if os.path.getsize(self.fedges) != edges.nbytes or not ok.all():
+                with open(self.fedges, 'wb') as f:
+                    f.write(edges[ok].tobytes())
+
+    def id(self, pano_id):
+        j = self.ids.get(pano_id)
+        if j is None:
+            j = self.ids[pano_id] = len(self.ids)
+            self.nodes.append(pano_id)
+        return j
+
+    def add(self, pano_id, links):
+        """
+        Adds edges of a visited panorama.
+        :param pano_id: string - panorama id hash
+        :param links: list of tuples (pano_id, etype, yaw) - see
+                      Panorama.getLinks()
+        """
+        with self.lock:
+            src = self.id(pano_id)
+            for dst, etype, yaw in links:
+                self.edges.append((src, self.id(dst), etype, yaw))
+            if len(self.edges) >= self.n_buf:
+                self._write()
+
+    def _write(self):
+        # Nodes first, edges never refer to unknown nodes
+        if self.nodes:
+            with open(self.fnodes, 'a') as f:
+                f.write(''.join(pid + '\n' for pid in self.nodes))
+            self.nodes = []
+        if self.edges:
+            with open(self.fedges, 'ab') as f:
+                f.write(np.array(self.edges, dtype=EDGE).tobytes())
+            self.edges = []
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def close(self):
+        """ Writes the log and compacts it into CSR arrays """
+        self.flush()
+        build(self.root)
+
+
+def build(root):
+    """
+    Compacts the edge log of a crawl into CSR arrays, repeated
+    edges are merged.
+    :param root: string - crawl directory DIR/LABEL
+    :return: tuple - (# nodes, # edges)
+    """
+    gdir = os.path.join(root, 'graph')
+    with open(os.path.join(gdir, 'nodes.txt')) as f:
+        n = sum(1 for _ in f)
+    fedges = os.path.join(gdir, 'edges.bin')
+    edges = np.fromfile(fedges, EDGE) if os.path.exists(fedges) else np.zeros(0, EDGE)
+
+    # Sorted by source node, then target and type
+    key = (edges['src'].astype(np.int64) << 33) | (edges['dst'].astype(np.int64) << 1) | edges['etype']
+    _, first = np.unique(key, return_index=True)
+    edges = edges[first]
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edges['src'], minlength=n), out=indptr[1:])
+    arrays = {
+        'indptr':   indptr,
+        'indices':  edges['dst'],
+        'etype':    edges['etype'],
+        'yaw':      edges['yaw'],
+    }
+    for name, dtype in CSR:
+        with open(os.path.join(gdir, name + '.bin'), 'wb') as f:
+            f.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+    return n, len(edges)
+
+
+class Graph:
+    """
+    Street graph in CSR format, the arrays are memory-mapped.
+    """
+    def __init__(self, root):
+        gdir = os.path.join(root, 'graph')
+        with open(os.path.join(gdir, 'nodes.txt')) as f:
+            self.nodes = [line.rstrip('\n') for line in f]
+        self.ids = dict((pid, j) for j, pid in enumerate(self.nodes))
+
+        for name, dtype in CSR:
+            fname = os.path.join(gdir, name + '.bin')
+            if os.path.getsize(fname):
+                arr = np.memmap(fname, dtype, 'r')
+            else:
+                arr = np.zeros(0, dtype)
+            setattr(self, name, arr)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def edges(self, j):
+        """
+        :param j: int - node id
+        :return: tuple of arrays - (target node ids, types, yaws)
+        """
+        a, b = self.indptr[j], self.indptr[j + 1]
+        return self.indices[a:b], self.etype[a:b], self.yaw[a:b]
+
+    def neighbours(self, pano_id, etype=None):
+        """
+        :param pano_id: string - panorama id hash
+        :param etype: int - SPATIAL or TEMPORAL, default both
+        :return: list of tuples (pano_id, etype, yaw)
+        """
+        j = self.ids.get(pano_id)
+        if j is None or j >= len(self):
+            return []
+        dst, types, yaws = self.edges(j)
+        return [(self.nodes[d], int(t), float(y))
+                for d, t, y in zip(dst, types, yaws)
+                if etype is None or t == etype]
+
+
+def load(root):
+    """
+    Memory-maps the street graph of a crawl built by build().
+    :param root: string - crawl directory DIR/LABEL
+    :return: Graph
+    """
+    return Graph(root)
@@ -0,0 +1,147 @@
+import json
+import time
+import threading
+import itertools
+
+'''
+Pools of hosts serving the same endpoint. Each request picks a host
+from the pool of its endpoint, request latency and errors are reported
+back. A host failing repeatedly is removed from the pool for a while.
+Mirrors or a local caching proxy can be added to the pools.
+'''
+
+
+class Host:
+    def __init__(self, url):
+        self.url = url
+        self.latency = None             # moving average [s]
+        self.active = 0                 # requests in progress
+        self.n_ok = 0
+        self.n_err = 0
+        self.n_fails = 0                # consecutive errors
+        self.banned = 0                 # banned until this time
+
+
+class HostPool:
+    """
+    Host selection policies:
+    'roundrobin'    - hosts in turn
+    'leastloaded'   - the lowest (active requests + 1) * average latency,
+                      hosts without latency first, the least active
+    """
+    alpha = .2                          # latency moving average weight
+    n_fails = 3                         # consecutive errors to ban a host
+    t_ban = 60                          # ban period [s]
+
+    def __init__(self, urls, policy='leastloaded'):
+        if policy not in ('roundrobin', 'leastloaded'):
+            raise ValueError('Unknown host selection policy ' + policy)
+        self.hosts = [Host(url) for url in urls]
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.cycle = itertools.cycle(self.hosts)
+
+    def available(self):
+        t = time.time()
+        hosts = [h for h in self.hosts if h.banned <= t]
+        if not hosts:                   # never left without a host
+            hosts = [min(self.hosts, key=lambda h: h.banned)]
+        return hosts
+
+    def choose(self):
+        """
+        Selects a host for a request, report() must follow.
+        :return: string - base URL
+        """
+        with self.lock:
+            hosts = self.available()
+            if self.policy == 'roundrobin':
+                h = next(self.cycle)
+                while h not in hosts:
+                    h = next(self.cycle)
+            else:
+                # Unmeasured hosts first, spread over by active requests
+                h = min(hosts, key=lambda h: (h.latency is not None,
+                                              (h.active + 1) * (h.latency or 1)))
+            h.active += 1
+            return h.url
+
+    def report(self, url, latency, ok):
+        """
+        Reports a finished request.
+        :param url: string - base URL returned by choose()
+        :param latency: float - request duration [s]
+        :param ok: boolean - request succeeded
+        """
+        with self.lock:
+            for h in self.hosts:
+                if h.url == url:
+                    break
+            else:
+                return
+            h.active -= 1
+            if ok:
+                h.n_ok += 1
+                h.n_fails = 0
+                h.latency = latency if h.latency is None else \
+                    (1 - self.alpha) * h.latency + self.alpha * latency
+            else:
+                h.n_err += 1
+                h.n_fails += 1
+                if h.n_fails >= self.n_fails:
+                    h.banned = time.time() + self.t_ban
+                    h.n_fails = 0
+
+    def stats(self):
+        """
+        :return: list of tuples (url, avg. latency [s], # ok, # errors)
+        """
+        with self.lock:
+            return [(h.url, h.latency, h.n_ok, h.n_err) for h in self.hosts]
+
+
+# Default pools of endpoints
+pools = {
+    'panoid':       HostPool(['https://geo%d.ggpht.com/cbk' % j for j in range(4)]),
+    'tile':         HostPool(['https://geo%d.ggpht.com/cbk' % j for j in range(4)]),
+    'meta':         HostPool(['https://cbks%d.google.com/cbk' % j for j in range(4)]),
+    'photometa':    HostPool(['https://www.google.fr/maps/photometa/v1']),
+}
+
+
+def configure(endpoint, urls, policy='leastloaded'):
+    """
+    Replaces the host pool of an endpoint.
+    :param endpoint: string - 'panoid', 'tile', 'meta' or 'photometa'
+    :param urls: list of strings - base URLs
+    :param policy: string - 'roundrobin' or 'leastloaded'
+    """
+    if endpoint not in pools:
+        raise ValueError('Unknown endpoint ' + endpoint)
+    pools[endpoint] = HostPool(urls, policy)
+
+
+def load(fname):
+    """
+    Configures host pools from a JSON file, e.g.
+    {"tile": {"urls": ["http://localhost:8080/cbk"], "policy": "roundrobin"},
+     "meta": ["https://cbks0.google.com/cbk", "https://cbks1.google.com/cbk"]}
+    :param fname: string - filename
+    """
+    with open(fname) as f:
+        conf = json.load(f)
+    for endpoint, item in conf.items():
+        if isinstance(item, dict):
+            configure(endpoint, item['urls'], item.get('policy', 'leastloaded'))
+        else:
+            configure(endpoint, item)
+
+
+def summary():
+    """ Per-host statistics as a printable string """
+    lines = []
+    for endpoint in sorted(pools):
+        for url, latency, n_ok, n_err in pools[endpoint].stats():
+            lat = '%.3f s' % latency if latency is not None else '-'
+            lines.append('%-10s %-45s %10s ok: %d err: %d' % (endpoint, url, lat, n_ok, n_err))
+    return '\n'.join(lines)
@@ -0,0 +1,361 @@
+import os
+import threading
+import numpy as np
+from math import pi, cos, floor
+
+'''
+Columnar index of a crawl. Each column is a raw little endian
+array appended into DIR/index/<column>.bin, so the index can be
+memory-mapped and queried without loading panorama metadata.
+DIR/index/rows.txt holds the number of rows written to all the
+columns, rows of an interrupted batch write beyond it are dropped.
+The spatial grid of the columns is saved next to them as
+grid_order.bin and grid_keys.bin, DIR/index/grid.txt holds the
+number of indexed rows and the cell size.
+'''
+COLUMNS = [
+    ('pano_id', 'S32'),
+    ('lat',     '<f8'),
+    ('lng',     '<f8'),
+    ('year',    '<i2'),
+    ('month',   '<i1'),
+    ('zooms',   '<u1'),             # bit j set if zoom j image saved
+    ('depth',   '<u1'),             # 1 if depth data saved
+]
+
+GRID = [
+    ('grid_order',  '<i8'),
+    ('grid_keys',   '<i8'),
+]
+
+R_EARTH = 6371000.0                 # meters
+
+
+class CrawlIndex:
+    """
+    Appends rows into the columnar index. Rows are buffered
+    and written in batches of n_buf rows.
+    """
+    n_buf = 256
+
+    def __init__(self, root):
+        self.root = root
+        self.dir = os.path.join(root, 'index')
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        self.lock = threading.Lock()
+        self.rows = []
+        self.n = committed(self.dir)
+        for name, dtype in COLUMNS:         # drop an interrupted batch
+            fname = os.path.join(self.dir, name + '.bin')
+            size = self.n * np.dtype(dtype).itemsize
+            if os.path.exists(fname) and os.path.getsize(fname) > size:
+                with open(fname, 'r+b') as f:
+                    f.truncate(size)
+
+    def add(self, pano_id, latlng, date, zooms=(), depth=False):
+        """
+        Adds a panorama into the index.
+        :param pano_id: string - panorama id hash
+        :param latlng: tuple (lat, lng)
+        :param date: tuple (year, month)
+        :param zooms: int iterable - saved zoom levels
+        :param depth: boolean - depth data saved
+        """
+        mask = 0
+        for z in zooms:
+            mask |= 1 << z
+        year, month = [x if x is not None else 0 for x in date]
+        with self.lock:
+            self.rows.append((pano_id, latlng[0], latlng[1], year, month, mask, depth))
+            if len(self.rows) >= self.n_buf:
+                self._write()
+
+    def _write(self):
+        if not self.rows:
+            return
+        cols = zip(*self.rows)
+        for (name, dtype), col in zip(COLUMNS, cols):
+            with open(os.path.join(self.dir, name + '.bin'), 'ab') as f:
+                f.write(np.array(col, dtype=dtype).tobytes())
+        self.n += len(self.rows)
+        self.rows = []
+
+        # Rows are committed once written to all columns
+        fname = os.path.join(self.dir, 'rows.txt')
+        with open(fname + '.tmp', 'w') as f:
+            f.write('%d\n' % self.n)
+        os.rename(fname + '.tmp', fname)
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def close(self):
+        """ Writes buffered rows and saves the spatial grid """
+        self.flush()
+        if os.path.exists(os.path.join(self.dir, COLUMNS[0][0] + '.bin')):
+            build(self.root)
+
+
+def committed(idir):
+    """
+    Number of rows written to all columns of the index.
+    :param idir: string - index directory DIR/LABEL/index
+    """
+    try:
+        with open(os.path.join(idir, 'rows.txt')) as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        # Index of an older version, the shortest column
+        sizes = []
+        for name, dtype in COLUMNS:
+            fname = os.path.join(idir, name + '.bin')
+            fsize = os.path.getsize(fname) if os.path.exists(fname) else 0
+            sizes.append(fsize // np.dtype(dtype).itemsize)
+        return min(sizes)
+
+
+def load(root):
+    """
+    Memory-maps the columnar index of a crawl.
+    :param root: string - crawl directory DIR/LABEL
+    :return: dictionary - {column name: numpy memmap}
+    """
+    idir = os.path.join(root, 'index')
+    n = committed(idir)             # not an interrupted batch write
+    if n == 0:
+        return dict((name, np.zeros(0, dtype)) for name, dtype in COLUMNS)
+
+    return dict(
+        (name, np.memmap(os.path.join(idir, name + '.bin'), dtype, 'r', shape=(n,)))
+        for name, dtype in COLUMNS
+    )
+
+
+class GridIndex:
+    """
+    Spatial grid over the index columns. Panoramas are sorted by
+    the key of their grid cell, a cell range along longitude is then
+    a contiguous slice found by binary search.
+    """
+    def __init__(self, cols, cell=100.0, order=None, keys=None):
+        """
+        :param cols: dictionary - columns returned by load()
+        :param cell: float - grid cell size in meters
+        :param order: numpy array - saved row order, see build()
+        :param keys: numpy array - saved sorted cell keys
+        """
+        self.cols = cols
+        self.cell_size = cell
+        self.step = cell / (R_EARTH * pi / 180)             # degrees
+        if order is None:
+            keys = self.key(self.cell(cols['lat']), self.cell(cols['lng']))
+            order = np.argsort(keys, kind='mergesort')
+            keys = keys[order]
+        self.order = order
+        self.keys = keys
+
+    def save(self, idir):
+        """
+        Saves the grid into the index directory, grid.txt is
+        written last and marks the saved grid complete.
+        """
+        fgrid = os.path.join(idir, 'grid.txt')
+        if os.path.exists(fgrid):
+            os.remove(fgrid)
+        for name, dtype in GRID:
+            arr = self.order if name == 'grid_order' else self.keys
+            with open(os.path.join(idir, name + '.bin'), 'wb') as f:
+                f.write(np.ascontiguousarray(arr, dtype=dtype).tobytes())
+        with open(fgrid, 'w') as f:
+            f.write('%d %r\n' % (len(self.order), self.cell_size))
+
+    def cell(self, deg):
+        return np.floor(np.asarray(deg) / self.step).astype(np.int64)
+
+    def key(self, cx, cy):
+        return (cx + 2**20) * 2**22 + (cy + 2**21)
+
+    def _candidates(self, topleft, btmright):
+        cx0, cx1 = self.cell(btmright[0]), self.cell(topleft[0])
+        cy0, cy1 = self.cell(topleft[1]), self.cell(btmright[1])
+        parts = []
+        for cx in range(cx0, cx1 + 1):
+            i = np.searchsorted(self.keys, self.key(cx, cy0), 'left')
+            j = np.searchsorted(self.keys, self.key(cx, cy1), 'right')
+            parts.append(self.order[i:j])
+        if not parts:
+            return np.zeros(0, np.int64)
+        return np.concatenate(parts)
+
+    def box(self, topleft, btmright):
+        """
+        Panoramas inside a GPS box.
+        :param topleft: tuple (lat, lng) - top left corner
+        :param btmright: tuple (lat, lng) - bottom right corner
+        :return: numpy array - row indices
+        """
+        idx = self._candidates(topleft, btmright)
+        lt, ln = self.cols['lat'][idx], self.cols['lng'][idx]
+        inside = (lt <= topleft[0]) & (lt > btmright[0]) & \
+                 (ln >= topleft[1]) & (ln < btmright[1])
+        return np.sort(idx[inside])
+
+    def radius(self, latlng, r):
+        """
+        Panoramas within a radius around a point.
+        :param latlng: tuple (lat, lng) - center GPS
+        :param r: float - radius in meters
+        :return: numpy array - row indices
+        """
+        dlat = r / (R_EARTH * pi / 180)
+        dlng = dlat / max(cos(latlng[0] * pi / 180), 1e-6)
+        idx = self._candidates((latlng[0] + dlat, latlng[1] - dlng),
+                               (latlng[0] - dlat, latlng[1] + dlng))
+        d = distance(latlng, self.cols['lat'][idx], self.cols['lng'][idx])
+        return np.sort(idx[d < r])
+
+
+class CellQuota:
+    """
+    Occupancy of square grid cells of cell x cell meters, at most
+    quota panoramas are taken per cell. Check is O(1).
+    """
+    def __init__(self, cell, quota=1):
+        self.step = cell / (R_EARTH * pi / 180)             # degrees of latitude
+        self.quota = quota
+        self.lock = threading.Lock()
+        self.n = dict()                                     # {cell: # taken}
+
+    def key(self, latlng):
+        lat, lng = latlng
+        row = int(floor(lat / self.step))
+        scale = cos((row + .5) * self.step * pi / 180)      # same along a row
+        return row, int(floor(lng * scale / self.step))
+
+    def take(self, latlng):
+        """
+        Takes a place in the cell of latlng if there is any left.
+        :return: boolean - True if taken
+        """
+        if latlng[0] is None:
+            return False
+        k = self.key(latlng)
+        with self.lock:
+            n = self.n.get(k, 0)
+            if n >= self.quota:
+                return False
+            self.n[k] = n + 1
+            return True
+
+    def add(self, latlng):
+        """ Marks a place in the cell of latlng as taken """
+        k = self.key(latlng)
+        with self.lock:
+            self.n[k] = self.n.get(k, 0) + 1
+
+
+def build(root, cell=100.0):
+    """
+    Sorts the index rows of a crawl by grid cells and saves
+    the grid next to the columns.
+    :param root: string - crawl directory DIR/LABEL
+    :return: GridIndex
+    """
+    grid = GridIndex(load(root), cell)
+    grid.save(os.path.join(root, 'index'))
+    return grid
+
+
+def grid(root, cols, cell=100.0):
+    """
+    Memory-maps the saved grid of the index. A grid that does not
+    cover all rows, e.g. of a crawl in progress, is built again and
+    saved if the directory is writable.
+    :param root: string - crawl directory DIR/LABEL
+    :param cols: dictionary - columns returned by load()
+    :return: GridIndex
+    """
+    idir = os.path.join(root, 'index')
+    n = len(cols['pano_id'])
+    try:
+        with open(os.path.join(idir, 'grid.txt')) as f:
+            n_grid, cell_grid = f.read().split()
+    except (IOError, OSError, ValueError):
+        n_grid, cell_grid = -1, None
+    if int(n_grid) == n and n > 0 and float(cell_grid) == cell:
+        order, keys = [np.memmap(os.path.join(idir, name + '.bin'), dtype, 'r', shape=(n,))
+                       for name, dtype in GRID]
+        return GridIndex(cols, cell, order, keys)
+
+    g = GridIndex(cols, cell)
+    try:
+        g.save(idir)
+    except (IOError, OSError):
+        pass                        # read-only data set
+    return g
+
+
+def distance(latlng, lat, lng):
+    """
+    Haversine distance in meters from a point to arrays of points.
+    """
+    lat0, lng0 = np.radians(latlng[0]), np.radians(latlng[1])
+    lat, lng = np.radians(lat), np.radians(lng)
+    a = np.sin((lat - lat0) / 2)**2 + \
+        np.cos(lat0) * np.cos(lat) * np.sin((lng - lng0) / 2)**2
+    return 2 * R_EARTH * np.arcsin(np.sqrt(a))
+
+
+def dates(cols, idx, since=None, until=None):
+    """
+    Filters row indices by panorama date.
+    :param since: tuple (year, month) or None
+    :param until: tuple (year, month) or None
+    :return: numpy array - row indices
+    """
+    ym = cols['year'][idx].astype(np.int32) * 12 + cols['month'][idx]
+    keep = np.ones(len(idx), dtype=bool)
+    if since:
+        keep &= ym >= since[0] * 12 + since[1]
+    if until:
+        keep &= ym <= until[0] * 12 + until[1]
+    return idx[keep]
+
+
+def unique(cols, idx):
+    """
+    Drops repeated rows of the same panorama, those may appear when
+    an interrupted crawl is resumed or a data set is updated. The
+    last row of a panorama is kept, it has the current outputs.
+    :param idx: numpy array - sorted row indices
+    """
+    rev = idx[::-1]
+    _, last = np.unique(cols['pano_id'][rev], return_index=True)
+    return np.sort(rev[last])
+
+
+def query(root, latlng=None, r=None, topleft=None, btmright=None,
+          since=None, until=None):
+    """
+    Lists panoramas of a crawl within a radius or inside a GPS box
+    and optionally within a date range.
+    :param root: string - crawl directory DIR/LABEL
+    :param latlng: tuple (lat, lng) - center GPS, radius query
+    :param r: float - radius in meters
+    :param topleft: tuple (lat, lng) - top left corner, box query
+    :param btmright: tuple (lat, lng) - bottom right corner
+    :param since: tuple (year, month) or None
+    :param until: tuple (year, month) or None
+    :return: tuple - (columns, numpy array of row indices)
+    """
+    cols = load(root)
+    if latlng:
+        idx = grid(root, cols).radius(latlng, r)
+    elif topleft:
+        idx = grid(root, cols).box(topleft, btmright)
+    else:
+        idx = np.arange(len(cols['pano_id']))
+    idx = dates(cols, idx, since, until)
+    return cols, unique(cols, idx)
@@ -0,0 +1,168 @@
+import re
+import json
+import threading
+import logging
+from Queue import Queue
+from collections import deque
+from math import cos, pi
+from panorama import Panorama
+from database import InFlight, Sentinel
+
+loger = logging.getLogger('lookup')
+loger.setLevel(logging.WARNING)
+
+
+class Lookup:
+    """
+    Resolves GPS points to pano_ids concurrently. Points are snapped
+    to a grid of cell x cell meters, points falling into the same
+    cell share one request. Answers are cached per cell, failed
+    requests are retried n_retry times and not cached. Requesting
+    threads run while run() is being consumed.
+    """
+    n_retry = 3
+    def __init__(self, radius=15, n_threads=16, cell=5.0):
+        """
+        :param radius: float - search radius in meters
+        :param n_threads: int - number of requesting threads
+        :param cell: float - grid cell size in meters
+        """
+        self.radius = radius
+        self.step = cell / 111320.0                 # meters to degrees of latitude
+        self.cache = dict()                         # {cell: pano_id}
+        self.inflight = InFlight()
+        self.n_threads = n_threads
+
+        self.q = Queue()
+        self.threads = []
+
+    def start(self):
+        for _ in range(self.n_threads):
+            t = threading.Thread(target=self.worker)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def close(self):
+        """
+        Stops the requesting threads, points queued and not
+        requested yet are dropped.
+        """
+        with self.q.mutex:
+            self.q.unfinished_tasks -= len(self.q.queue)
+            self.q.queue.clear()
+        for _ in self.threads:
+            self.q.put(Sentinel())
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def cell(self, latlng):
+        lat, lng = latlng
+        cx = int(round(lat / self.step))
+        cy = int(round(lng * cos(lat * pi / 180) / self.step))
+        return cx, cy
+
+    def resolve(self, latlng):
+        """
+        Blocking lookup of a single point.
+        :param latlng: tuple (lat, lng)
+        :return: string - pano_id or None
+        """
+        key = self.cell(latlng)
+        if key in self.cache:
+            return self.cache[key]
+        return self.inflight.fetch(key, lambda: self._request(key, latlng))
+
+    def _request(self, key, latlng):
+        for _ in range(self.n_retry):
+            try:
+                pano_id = Panorama().getPanoID(latlng, self.radius)
+            except Exception as e:
+                msg = '%.6f %.6f pano_id lookup failed - %s: %s' % (
+                    latlng[0], latlng[1], type(e).__name__, str(e))
+                loger.warn(msg)
+                continue
+            self.cache[key] = pano_id           # None if there is no panorama
+            return pano_id
+        return None
+
+    def worker(self):
+        while True:
+            item = self.q.get()
+            if isinstance(item, Sentinel):
+                self.q.task_done()
+                return
+            latlng, res = item
+            res[1] = self.resolve(latlng)
+            res[0].set()
+            self.q.task_done()
+
+    def run(self, latlngs, window=1024):
+        """
+        Generator of lookup results in the input order. At most
+        window points are being resolved ahead of the consumer.
+        :param latlngs: iterable of tuples (lat, lng)
+        :param window: int - look-ahead
+        :return: generator of tuples (latlng, pano_id)
+        """
+        pending = deque()
+        self.start()
+        try:
+            for latlng in latlngs:
+                res = [threading.Event(), None]
+                self.q.put((latlng, res))
+                pending.append((latlng, res))
+                if len(pending) >= window:
+                    ll, res = pending.popleft()
+                    res[0].wait()
+                    yield ll, res[1]
+
+            while pending:
+                ll, res = pending.popleft()
+                res[0].wait()
+                yield ll, res[1]
+        finally:
+            self.close()            # also when the generator is closed early
+
+
+def lookup(latlngs, radius=15, n_threads=16, cell=5.0):
+    """
+    Resolves many GPS points to pano_ids concurrently.
+    :param latlngs: iterable of tuples (lat, lng)
+    :param radius: float - search radius in meters
+    :param n_threads: int - number of requesting threads
+    :param cell: float - points within a cell share the answer
+    :return: generator of tuples (latlng, pano_id) in input order
+    """
+    return Lookup(radius, n_threads, cell).run(latlngs)
+
+
+def readPoints(f):
+    """
+    Reads 'lat,lng' or 'lat lng' lines of a file, lines that
+    are not numbers (header, comments) are skipped.
+    :param f: file object
+    :return: generator of tuples (lat, lng)
+    """
+    for line in f:
+        item = re.split(r'[,;\s]+', line.strip())
+        try:
+            yield float(item[0]), float(item[1])
+        except (ValueError, IndexError):
+            continue
+
+
+def writeResults(results, f, fmt='csv'):
+    """
+    Writes lookup results as CSV 'lat,lng,pano_id' or JSON lines.
+    :param results: iterable of tuples (latlng, pano_id)
+    :param f: file object
+    :param fmt: string - 'csv' or 'json'
+    """
+    for (lat, lng), pano_id in results:
+        if fmt == 'json':
+            f.write(json.dumps({'lat': lat, 'lng': lng, 'pano_id': pano_id}) + '\n')
+        else:
+            f.write('%.6f,%.6f,%s\n' % (lat, lng, pano_id or ''))
+        f.flush()
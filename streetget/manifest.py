@@ -0,0 +1,88 @@
+import os
+import hashlib
+import threading
+
+
+class Manifest:
+    """
+    Record of saved members of a data set. Append-only file
+    DIR/LABEL/manifest.txt, one line per completely written member:
+    pano_id member size sha1
+    """
+    def __init__(self, root):
+        self.fname = os.path.join(root, 'manifest.txt')
+        self.lock = threading.Lock()
+        self.d = dict()                 # {pano_id: set of members}
+        if os.path.exists(self.fname):
+            self.load()
+        self.f = open(self.fname, 'a')
+
+    def load(self):
+        with open(self.fname) as f:
+            for line in f:
+                item = line.split()
+                if len(item) != 4:
+                    continue                    # incomplete last line
+                self.d.setdefault(item[0], set()).add(item[1])
+
+    def add(self, pano_id, member, data):
+        """
+        Records a member written to the storage.
+        :param data: string - written data
+        """
+        line = '%s %s %d %s\n' % (pano_id, member, len(data), hashlib.sha1(data).hexdigest())
+        with self.lock:
+            self.f.write(line)
+            self.d.setdefault(pano_id, set()).add(member)
+
+    def has(self, pano_id, member):
+        with self.lock:
+            return member in self.d.get(pano_id, ())
+
+    def discard(self, pano_id, member):
+        """ Forgets a member, e.g. a corrupt one to be written again """
+        with self.lock:
+            self.d.get(pano_id, set()).discard(member)
+
+    def flush(self):
+        with self.lock:
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+    def verify(self, storage, checksum=False):
+        """
+        Checks sizes of recorded members in the storage, the last record
+        of a member written more times is used. Compact metadata records
+        are not checked.
+        :param checksum: boolean - members are also read and their
+                         checksums checked, the whole data set is read
+        :return: generator of tuples (pano_id, member) - missing or corrupt
+        """
+        self.flush()
+        last = dict()                           # {(pano_id, member): (size, sha1)}
+        with open(self.fname) as f:
+            for line in f:
+                item = line.split()
+                if len(item) != 4 or item[1] == 'meta.jsonl':
+                    continue                    # record in a MetaStore batch
+                last[(item[0], item[1])] = (item[2], item[3])
+
+        for (pano_id, member), (size, sha1) in sorted(last.items()):
+            if not checksum:
+                try:
+                    ok = storage.size(pano_id, member) == int(size)
+                except (IOError, OSError, KeyError):
+                    ok = False
+                if not ok:
+                    yield pano_id, member
+                continue
+            try:
+                data = storage.read(pano_id, member)
+            except (IOError, OSError, KeyError):
+                data = None
+            if data is None or len(data) != int(size) or \
+                    hashlib.sha1(data).hexdigest() != sha1:
+                yield pano_id, member
@@ -4,12 +4,18 @@ from itertools import product
 from urllib import urlencode
 from struct import Struct
 import threading
+import time
+from collections import OrderedDict
 import json
 import re
 import requests
 import sys
 import logging
 import numpy as np
+import depth
+import hosts
+import render
+import graph
 from PIL import Image
 from numpy import array
 
@@ -24,15 +30,127 @@ headers = {
     'User-agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:42.0) Gecko/20100101 Firefox/42.0'      # may be used later to fool server
 }
 
+# Session shared by all panoramas and threads keeps connections alive
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=64))
+
 loger = logging.getLogger('panorama')
 loger.setLevel(logging.WARNING)
 
+
+class TimeGroups:
+    """
+    Cache of temporal links shared by the panoramas of a time machine
+    group. The photometa response of one member lists the whole group,
+    the other members take the links from it instead of requesting
+    their own response. An entry is used once, the least recently
+    added are dropped when there are more than n_max entries.
+    """
+    n_max = 20000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.d = OrderedDict()          # {pano_id: (source pano_id, links)}
+        self.enabled = True
+        self.n_saved = 0                # photometa requests saved
+
+    def add(self, pano_ids, source, links):
+        """
+        :param pano_ids: string iterable - group members
+        :param source: string - pano_id of the photometa response
+        :param links: list of tuples (pano_id, (year, month)) - see
+                      temporalLinks()
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            for pid in pano_ids:
+                self.d[pid] = (source, links)
+            while len(self.d) > self.n_max:
+                self.d.popitem(last=False)
+
+    def pop(self, pano_id):
+        """
+        :return: tuple - (source pano_id, links) of the group of
+                 pano_id or (None, None)
+        """
+        with self.lock:
+            item = self.d.pop(pano_id, None)
+            if item is None:
+                return None, None
+            self.n_saved += 1
+            return item
+
+# Shared by all panoramas and threads
+timegroups = TimeGroups()
+
+
+def photometaJSON(msg):
+    """
+    JSON text of the photometa response. The response is a .js file,
+    its first line is dropped and empty items of sparse arrays such
+    as '[,' or ',,' are filled with null. It is done by C string
+    operations, each pass of ',,' halves the longest run of commas.
+    :param msg: string - content of the .js file
+    :return: string - JSON
+    """
+    msg = msg.split('\n', 2)[1]
+    msg = msg.replace('[,', '[null,')
+    while ',,' in msg:
+        msg = msg.replace(',,', ',null,')
+    return msg
+
+
+def groupRef(pano_id, source, links):
+    """
+    Timemachine metadata of a panorama whose group was listed by the
+    photometa response of another member. Only the temporal links are
+    kept, the response describes the source panorama.
+    :param pano_id: string - panorama the metadata are saved under
+    :param source: string - pano_id of the photometa response
+    :param links: list of tuples (pano_id, (year, month))
+    :return: dictionary
+    """
+    return {
+        'pano_id':      pano_id,
+        'group_ref':    source,
+        'links':        [[pid, list(t)] for pid, t in links],
+    }
+
+
+def temporalLinks(time_meta):
+    """
+    Temporal panorama links of timemachine metadata,
+    raises an exception if there are none.
+    :param time_meta: nested list - parsed timemachine metadata,
+                      or a group reference, see groupRef()
+    :return: list of tuples (pano_id, (year, month))
+    """
+    if isinstance(time_meta, dict):
+        return [(pid, tuple(t)) for pid, t in time_meta['links']]
+
+    aux = time_meta[1][0][5][1]  # interesting part of the meta list
+
+    # Get timestamps of available time machine panoramas
+    tstamps = []
+    for x in aux[8]:
+        tstamps.append(tuple(x[1]))  # year, month
+
+    # Get corresponding panoID hashes
+    pano_ids = [''] * len(tstamps)              # empty string list alloc
+    for j in range(1, len(tstamps) + 1):
+        pano_ids[-j] = aux[3][0][-j][0][1]      # pano_id hash string
+
+    return zip(pano_ids, tstamps)
+
 class Panorama:
     pano_id = None
     meta = None
     time_meta = None
+    time_meta_text = None       # JSON of time_meta as received
     depthdata = None
     depthmap = None
+    images = None               # {zoom: JPEG data} when fetched by a stream
 
     def __init__(self, pano_id=None, latlng=None, radius=15):
         if not pano_id and not latlng:
@@ -53,7 +171,7 @@ class Panorama:
         :returns string - pano_id hash
         """
         # Base URL and headers
-        url = 'https://geo0.ggpht.com/cbk'
+        url = hosts.pools['panoid']
 
         # Query parameters (reverse engineered by googling)
         query = {
@@ -113,6 +231,27 @@ class Panorama:
 
         return pano_ids
 
+    def getLinks(self, time=True):
+        """
+        Links to adjacent panoramas, edges of the street graph.
+        :param time: boolean - include temporal links
+        :return: list of tuples (pano_id, type, yaw) - type is
+                 graph.SPATIAL or graph.TEMPORAL, yaw is the compass
+                 heading of a spatial link [deg], NaN if unknown
+        """
+        links = []
+        for x in (self.meta or {}).get('Links', []):
+            try:
+                yaw = float(x['yawDeg'])
+            except (KeyError, TypeError, ValueError):
+                yaw = float('nan')
+            links.append((x['panoId'], graph.SPATIAL, yaw))
+        if time:
+            for pid, t in self.getTemporalNeighbours() or []:
+                if pid != self.pano_id:
+                    links.append((pid, graph.TEMPORAL, float('nan')))
+        return links
+
     def getTemporalNeighbours(self):
         """
         Extracts temporal panorama links from
@@ -122,17 +261,7 @@ class Panorama:
         #TODO: tt = (None, None)... return tt, following the same pattern
         # as e.g. getGPS
         try:
-            aux = self.time_meta[1][0][5][1]  # interesting part of the meta list
-
-            # Get timestamps of available time machine panoramas
-            tstamps = []
-            for x in aux[8]:
-                tstamps.append(tuple(x[1]))  # year, month
-
-            # Get corresponding panoID hashes
-            pano_ids = [''] * len(tstamps)              # empty string list alloc
-            for j in range(1, len(tstamps) + 1):
-                pano_ids[-j] = aux[3][0][-j][0][1]      # pano_id hash string
+            return temporalLinks(self.time_meta)
         except Exception as e:
             w = '%s \t %.6f %.6f\t temporal neighbours not found\n %s:%s' % (
                     self.pano_id, self.getGPS()[0], self.getGPS()[1],
@@ -141,8 +270,6 @@ class Panorama:
             loger.warn(w)
             return None
 
-        return zip(pano_ids, tstamps)
-
     def getGPS(self):
         ll = (None, None)
         try:
@@ -197,13 +324,29 @@ class Panorama:
         :param n_threads:
         :return: Image - panorama at given zoom level
         """
+        data = self.getTilesData(zoom, n_threads)
+        tiles = [Image.open(BytesIO(msg)) for msg in data]
+        return self.stitchTiles(tiles, zoom)
+
+    def getTilesData(self, zoom=5, n_threads=16, xys=None):
+        """
+        Fetches raw JPEG data of image tiles of the
+        panorama at given zoom level.
+        :param zoom: int [0-5] - zoom level
+        :param n_threads: int - number of fetching threads
+        :param xys: list of tuples (x, y) - tiles to fetch, default all
+        :return: list - JPEG strings, tile (x,y) at index y+th*x or
+                 in the order of xys
+        """
         if self.isCustom():
             raise NotImplementedError('Custom panorama is not implemented')
 
         tw, th = self.numTiles(zoom)
-        tiles = tw*th*[None]
+        if xys is None:
+            xys = list(product(range(tw), range(th)))
+        tiles = len(xys)*[None]
 
-        n_threads = min(n_threads, tw*th)
+        n_threads = min(n_threads, len(xys))
 
         sentinel = object()
         def worker(q):
@@ -212,8 +355,8 @@ class Panorama:
                 if item is sentinel:
                     q.task_done()
                     break
-                x,y = item
-                tiles[y+th*x] = self.getTile(x, y, zoom)
+                j, (x,y) = item
+                tiles[j] = self.getTileData(x, y, zoom)
                 q.task_done()
 
 
@@ -226,15 +369,60 @@ class Panorama:
             t.start()
 
         # Queueing jobs
-        for xy in product(range(tw), range(th)):
-            q.put(xy)
+        for item in enumerate(xys):
+            q.put(item)
         # Queueing sentinels to exit the threads
         for _ in range(n_threads):
             q.put(sentinel)
 
         q.join()            # all jobs finished
 
-        # Stitching tiles together
+        return tiles
+
+    def getLinkYaw(self, j=0):
+        """
+        Direction of the link to an adjacent panorama as
+        a yaw in the panorama image, 0 is the image center.
+        :param j: int - index of the link in meta['Links']
+        :return: float - yaw [deg] in range [-180, 180)
+        """
+        heading = float(self.meta['Links'][j]['yawDeg'])
+        yaw = heading - float(self.meta['Projection']['pano_yaw_deg'])
+        return (yaw + 180) % 360 - 180
+
+    def getViewTiles(self, yaw=0, pitch=0, fov=90, size=(640, 480), zoom=5):
+        """
+        Image tiles covered by a perspective view, see getView()
+        :return: list of tuples (x, y) - tile coordinates
+        """
+        return render.viewTiles(self.cropSize(zoom)[2:], yaw, pitch, fov, size)
+
+    def getView(self, yaw=0, pitch=0, fov=90, size=(640, 480), zoom=5, n_threads=16):
+        """
+        Gets perspective view of the panorama. Only the image
+        tiles the view covers are fetched, there is no stitching.
+        :param yaw: float - view direction [deg], 0 is the image
+                    center, see getLinkYaw() for link directions
+        :param pitch: float - view direction [deg], 0 is the horizon
+        :param fov: float - horizontal field of view [deg]
+        :param size: tuple (width, height) - view size
+        :param zoom: int [0-5] - zoom level of the sampled tiles
+        :return: Image - view
+        """
+        xys = self.getViewTiles(yaw, pitch, fov, size, zoom)
+        data = self.getTilesData(zoom, n_threads, xys)
+        tiles = dict((xy, Image.open(BytesIO(msg))) for xy, msg in zip(xys, data))
+        return render.perspectiveTiles(tiles, self.cropSize(zoom)[2:], yaw, pitch, fov, size)
+
+    def stitchTiles(self, tiles, zoom):
+        """
+        Stitches image tiles together and crops the result
+        in order to form a spherical panorama.
+        :param tiles: list - Image tiles, tile (x,y) at index y+th*x
+        :param zoom: int [0-5] - zoom level
+        :return: Image - panorama at given zoom level
+        """
+        tw, th = self.numTiles(zoom)
         pano = Image.new('RGB',(512*tw, 512*th))
         grid = [xy for xy in product(range(tw), range(th))]
 
@@ -252,7 +440,21 @@ class Panorama:
         :param zoom: int [0-5] - zoom level
         :return: Image - panorama tile
         """
-        url ='https://geo2.ggpht.com/cbk'
+        msg = self.getTileData(x, y, zoom)
+        file = BytesIO(msg)
+        img = Image.open(file)
+        return img
+
+    def getTileData(self, x, y, zoom=5):
+        """
+        Gets raw JPEG data of the panorama image tile
+        at position (x,y) as received from the server.
+        :param x: int - tile coordinate horizontal
+        :param y: int - tile coordinate vertical
+        :param zoom: int [0-5] - zoom level
+        :return: string - JPEG data
+        """
+        url = hosts.pools['tile']
         query = {
                     'output':   'tile',
                     'zoom':     zoom,
@@ -261,10 +463,22 @@ class Panorama:
                     'panoid':   self.pano_id
                 }
 
-        msg = self.requestData(url,query, headers=headers)
-        file = BytesIO(msg)
-        img = Image.open(file)
-        return img
+        return self.requestData(url,query, headers=headers)
+
+    def getLayout(self, zoom):
+        """
+        Layout of raw image tiles, describes how to stitch the
+        tiles and crop the panorama at given zoom level.
+        :param zoom: int [0-5] - zoom level
+        :return: dictionary - tile grid, tile size and crop box
+        """
+        return {
+            'zoom':         zoom,
+            'tiles':        self.numTiles(zoom),
+            'tile_size':    512,
+            'crop':         self.cropSize(zoom),
+            'tile_name':    'zoom_%d_{x}_{y}.jpg' % zoom,
+        }
     
     def getDepthData(self):
         encoded = self.meta['model']['depth_map']
@@ -305,31 +519,8 @@ class Panorama:
         :param zoom: int [0-5], default None
         :return img - PIL Image object
         """
-        size, lbls, planes = self.depthdata
-        w, h = size
-        pi = np.pi
-
-        # Rays from camera center in spherical coordinates
-        y, x = np.indices((h, w))           # grid of coordinates
-        offset = pi/2                       # no idea why not pi,
-        yaw = (w-1 - x) * 2*pi / (w-1) + offset
-        pitch = (h-1 - y) * pi / (h-1)      # 0 down, pi/2 horizontal, pi up
-
-        # Rays from spherical to cartesian
-        v = np.array([
-            np.sin(pitch) * np.cos(yaw),
-            np.sin(pitch) * np.sin(yaw),
-            np.cos(pitch)
-        ])
-        v = v.transpose(1, 2, 0)
-
-        # w x h x 3 normal, resp. w x h x 1 distance
-        n = np.array([planes[i][0] for i in lbls]).reshape((h, w, 3))
-        d = np.array([planes[i][1] for i in lbls]).reshape((h, w))
-        d[d == 0] = np.nan
-
-        # distance from camera centetr, ray inersection with plane
-        self.depthmap = d / np.abs(np.sum(v * n, axis=2))
+        # distance from camera center, ray intersection with plane
+        self.depthmap = depth.depthMap(self.depthdata)
 
         try:
             plt.imshow(self.depthmap)
@@ -348,6 +539,28 @@ class Panorama:
             img = img.resize((w,h), Image.NEAREST)
         return img
 
+    def getPointCloud(self, zoom=None, step=1):
+        """
+        Computes 3D points of the depth map in the camera frame
+        from depth data given by getDepthData().
+        :param zoom: int [0-5] - resolution of the panorama image at
+                     given zoom level, default native depth map size
+        :param step: int - subsampling, every step-th pixel
+        :return: numpy float32 array N x 3 - XYZ
+        """
+        if not self.depthdata:
+            self.getDepthData()
+
+        size = self.cropSize(zoom)[2:] if zoom is not None else None
+        return depth.pointCloud(self.depthdata, size, step)
+
+    def dumpPointCloud(self, zoom=None, step=1):
+        """
+        Point cloud from getPointCloud() encoded as binary PLY
+        :return: string - PLY data
+        """
+        return depth.dumpPly(self.getPointCloud(zoom, step))
+
     def saveDepthData(self, fname):
         """
         Saves depth data as JSON in following format:
@@ -366,11 +579,18 @@ class Panorama:
 
         :param fname - string, filename
         """
+        with open(fname, 'w') as f:
+            f.write(self.dumpDepthData())
+
+    def dumpDepthData(self):
+        """
+        Depth data serialized as JSON, see saveDepthData()
+        :return: string - JSON
+        """
         if not self.depthdata:
             self.getDepthData()
 
-        with open(fname, 'w') as f:
-            json.dump(self.depthdata, f)
+        return json.dumps(self.depthdata)
 
     def saveDepthImage(self, fname, zoom=None):
         """
@@ -382,13 +602,22 @@ class Panorama:
         :param fname: string file name
         :param zoom: int [0-5], default None
         """
+        with open(fname, 'wb') as f:
+            f.write(self.dumpDepthImage(zoom))
+
+    def dumpDepthImage(self, zoom=None):
+        """
+        Depth map image encoded as JPEG, see saveDepthImage()
+        :param zoom: int [0-5], default None
+        :return: string - JPEG data
+        """
         if not self.depthdata:
             self.getDepthData()
 
-        img = self.getDepthImg(zoom)
-        with open(fname, 'w') as f:
-            img.save(f, 'JPEG')
-
+        img = self.getDepthImg(zoom).convert('RGB')   # no alpha in JPEG
+        buf = BytesIO()
+        img.save(buf, 'JPEG')
+        return buf.getvalue()
 
     def numTiles(self, zoom):
         """
@@ -434,7 +663,7 @@ class Panorama:
         if not self.pano_id:
             return None
 
-        url = 'https://cbks1.google.com/cbk'
+        url = hosts.pools['meta']
         query = {
             'output':       'json',
             'v':            4,
@@ -468,13 +697,20 @@ class Panorama:
         """
         Gets raw timemachne metadata the panorama.
         The crazy 'query' string was reverse engineered by
-        listening to the network trafic.
-        :return: nested list from JSON
+        listening to the network trafic. Metadata of the time
+        machine group are requested once, the other members of
+        the group get a group reference with their temporal links
+        from the timegroups cache.
+        :return: nested list from JSON or dictionary, see groupRef()
         """
         if not self.pano_id:
             return None
 
-        url = 'https://www.google.fr/maps/photometa/v1'
+        source, links = timegroups.pop(self.pano_id)
+        if source is not None:
+            return groupRef(self.pano_id, source, links)
+
+        url = hosts.pools['photometa']
         query = {
             'authuser': 0,
             'hl': 'en',
@@ -488,22 +724,32 @@ class Panorama:
         if not msg:
             return None
 
+        data = self.parseTimeMeta(msg)
+        if data is not None and timegroups.enabled:
+            try:
+                tn = temporalLinks(data)
+            except Exception:
+                tn = []                 # no time machine, see getTemporalNeighbours
+            timegroups.add((x for x, t in tn if x != self.pano_id), self.pano_id, tn)
+        return data
+
+    def parseTimeMeta(self, msg):
+        """
+        Parses the raw timemachine response returned by the
+        photometa request. The JSON text is kept in time_meta_text
+        and saved by dumpTimeMeta() without encoding it again.
+        :param msg: string - content of the .js file
+        :return: nested list from JSON
+        """
         # Handle a content of the .js file retrieved form the server
         # Here again - reverse engineered. The js file contains
         # nested arrays with some useful info. String is
         # modified such that it can be loaded as JOSN.
-
-        # Trash the first line
-        pattern  = r'.+\n(.+)'
-        msg = re.match(pattern, msg).groups()[0]
-        # Find '[' or ',' followed by ',' and insert 'null' in between
-        pattern = r'([\[,])(?=,)'
-        msg = re.sub(pattern, r'\1null', msg)
-
         data = None
         try:
-            # Load the JSON nested list
-            data = json.loads(msg);
+            text = photometaJSON(msg)
+            data = json.loads(text)
+            self.time_meta_text = text
         except Exception as e:
             w = '%s has no time meta JSON, received: %s' % (self.pano_id, msg)
             loger.warn(w + str(e))
@@ -516,7 +762,28 @@ class Panorama:
         :param fname: string - filename
         """
         with open(fname, 'w') as f:
-            json.dump(self.meta, f)
+            f.write(self.dumpMeta())
+
+    def dumpMeta(self, depth=True):
+        """
+        Meta data serialized as JSON
+        :param depth: boolean - include depth map payload
+        :return: string - JSON
+        """
+        return json.dumps(self.meta if depth else self.getMetaNoDepth())
+
+    def getMetaNoDepth(self):
+        """
+        Meta data without the large base64 depth map payload,
+        used when depth data are stored separately.
+        :return: dictionary - shallow copy of the meta data
+        """
+        if not self.meta or 'depth_map' not in self.meta.get('model', ()):
+            return self.meta
+        meta = dict(self.meta)
+        meta['model'] = dict(meta['model'])
+        del meta['model']['depth_map']
+        return meta
 
     def saveTimeMeta(self, fname):
         """
@@ -524,7 +791,17 @@ class Panorama:
         :param fname: string - filename
         """
         with open(fname, 'w') as f:
-            json.dump(self.meta, f)
+            f.write(self.dumpTimeMeta())
+
+    def dumpTimeMeta(self):
+        """
+        Timemachine meta data serialized as JSON, the received
+        JSON is used when available.
+        :return: string - JSON
+        """
+        if self.time_meta_text is not None and self.time_meta is not None:
+            return self.time_meta_text
+        return json.dumps(self.time_meta)
 
     def saveImage(self, fname, zoom=5, n_threads=16):
         """
@@ -533,30 +810,47 @@ class Panorama:
         :param fname: string - filename
         :param zoom: int [0-5] - zoom-level
         """
+        with open(fname, 'wb') as f:
+            f.write(self.dumpImage(zoom, n_threads))
+
+    def dumpImage(self, zoom=5, n_threads=16):
+        """
+        Fetches panorama image at given zoom-level
+        and encodes it as JPEG.
+        :param zoom: int [0-5] - zoom-level
+        :return: string - JPEG data
+        """
         img = self.getImage(zoom, n_threads)
-        img.save(fname, 'JPEG')
+        buf = BytesIO()
+        img.save(buf, 'JPEG')
+        return buf.getvalue()
 
     def requestData(self, url, query, headers=None):
         """
         Sends GET URL request formed from a base url, a query string
         and headers. Returns whatever this request receives back.
-        :param url: string - base URL
+        :param url: string - base URL or HostPool to choose it from
         :param query: dictionary - url query paramteres as key-value
         :param headers: dictionary - header parameters as key-value
         :return: dictionary - data from returned JSON
         """
         # URL GET request
         query_str = urlencode(query).encode('ascii')
-        u = None
+        pool = url if isinstance(url, hosts.HostPool) else None
         # Handle loose internet connection via loop
         err = None
         for _ in range(10):
+            u = None
+            base = pool.choose() if pool else url
+            t = time.time()
             try:
-                u = requests.get(url + "?" + query_str, headers=headers)
+                u = session.get(base + "?" + query_str, headers=headers)
             except Exception as e:
                 print type(e).__name__ + str(e)
                 print 'URL request retry...'
                 err = e
+            if pool:
+                pool.report(base, time.time() - t, bool(u))
             if u:
                 break
         else:
@@ -0,0 +1,195 @@
+import threading
+from io import BytesIO
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+'''
+Rendering of spherical (equirectangular) panoramas into perspective
+views and cube map faces. Sampling positions depend only on the
+panorama size and the view, they are computed once and cached as
+remap tables. Rendering is then a vectorized bilinear lookup.
+
+Angles are in degrees. Yaw 0 is the center of the panorama image,
+positive to the right, pitch 0 is the horizon, positive up. The
+compass heading of yaw 0 is meta['Projection']['pano_yaw_deg'].
+'''
+
+# Cube map faces, (yaw, pitch) of their centers
+FACES = OrderedDict([
+    ('front',   (0, 0)),
+    ('right',   (90, 0)),
+    ('back',    (180, 0)),
+    ('left',    (-90, 0)),
+    ('up',      (0, 90)),
+    ('down',    (0, -90)),
+])
+
+_tables = OrderedDict()             # {(W, H, yaw, pitch, fov, w, h): table}
+_lock = threading.Lock()
+n_tables = 64                       # max. number of cached tables
+
+
+def directions(yaw, pitch, fov, w, h):
+    """
+    Longitude and latitude of the view ray of every pixel of
+    a pinhole camera w x h with horizontal field of view fov.
+    :return: tuple of numpy arrays h x w - (longitude, latitude) [rad]
+    """
+    f = .5 * w / np.tan(np.radians(fov) / 2)        # focal length [px]
+    y, x = np.indices((h, w), dtype=np.float64)
+    x = x - (w - 1) / 2.
+    y = (h - 1) / 2. - y                            # up
+    z = np.full_like(x, f)                          # forward
+
+    # Rotate by pitch around the horizontal axis, then by yaw
+    p, t = np.radians(pitch), np.radians(yaw)
+    y, z = y*np.cos(p) + z*np.sin(p), -y*np.sin(p) + z*np.cos(p)
+    x, z = x*np.cos(t) + z*np.sin(t), -x*np.sin(t) + z*np.cos(t)
+
+    return np.arctan2(x, z), np.arctan2(y, np.hypot(x, z))
+
+
+def table(size, yaw, pitch, fov, w, h):
+    """
+    Remap table of the view for a panorama of given size. Tables
+    are cached, do not modify.
+    :param size: tuple (W, H) - panorama size
+    :return: tuple - (flat indices 4 x h*w, weights 4 x h*w)
+    """
+    key = (size[0], size[1], yaw, pitch, fov, w, h)
+    with _lock:
+        if key in _tables:
+            return _tables[key]
+
+    W, H = size
+    lng, lat = directions(yaw, pitch, fov, w, h)
+    px = (lng / (2*np.pi) + .5) * W - .5
+    py = (.5 - lat / np.pi) * H - .5
+
+    x0, y0 = np.floor(px), np.floor(py)
+    wx, wy = (px - x0).ravel(), (py - y0).ravel()
+    x0 = x0.astype(np.int64).ravel()
+    y0 = y0.astype(np.int64).ravel()
+    x1 = (x0 + 1) % W                               # horizontal wrap
+    x0 = x0 % W
+    y1 = np.clip(y0 + 1, 0, H - 1)
+    y0 = np.clip(y0, 0, H - 1)
+
+    idx = np.array([y0*W + x0, y0*W + x1, y1*W + x0, y1*W + x1])
+    weights = np.array([(1-wx)*(1-wy), wx*(1-wy), (1-wx)*wy, wx*wy], dtype=np.float32)
+    t = idx, weights
+
+    with _lock:
+        _tables[key] = t
+        while len(_tables) > n_tables:
+            _tables.popitem(last=False)
+    return t
+
+
+def perspective(img, yaw=0, pitch=0, fov=90, size=(640, 480)):
+    """
+    Perspective view of the panorama.
+    :param img: Image - spherical panorama e.g. from Panorama.getImage()
+    :param yaw: float - view direction, horizontal [deg]
+    :param pitch: float - view direction, vertical [deg]
+    :param fov: float - horizontal field of view [deg]
+    :param size: tuple (width, height) - view size
+    :return: Image
+    """
+    w, h = size
+    idx, weights = table(img.size, yaw, pitch, fov, w, h)
+    img = img if img.mode == 'RGB' else img.convert('RGB')
+    pixels = np.asarray(img).reshape(-1, 3)         # uint8, no copy
+
+    out = np.zeros((w*h, 3), dtype=np.float32)
+    for j in range(4):
+        out += pixels[idx[j]] * weights[j][:, None]
+    out = np.clip(out + .5, 0, 255).astype(np.uint8)
+    return Image.fromarray(out.reshape(h, w, 3))
+
+
+def viewTiles(size, yaw=0, pitch=0, fov=90, vsize=(640, 480), tile=512):
+    """
+    Image tiles of a panorama of given size the view samples from,
+    across the horizontal wrap too.
+    :param size: tuple (W, H) - panorama size
+    :param vsize: tuple (width, height) - view size
+    :param tile: int - tile size
+    :return: list of tuples (x, y) - tile coordinates
+    """
+    idx, _ = table(size, yaw, pitch, fov, vsize[0], vsize[1])
+    W = size[0]
+    tx, ty = idx % W // tile, idx // W // tile
+    keys = np.unique(tx * 1024 + ty)
+    return [(int(k // 1024), int(k % 1024)) for k in keys]
+
+
+def perspectiveTiles(tiles, size, yaw=0, pitch=0, fov=90, vsize=(640, 480), tile=512):
+    """
+    Perspective view sampled directly from image tiles, no stitching.
+    :param tiles: dictionary - {(x, y): Image tile}, the tiles of
+                  viewTiles() at least
+    :param size: tuple (W, H) - size of the cropped panorama
+    :return: Image
+    """
+    w, h = vsize
+    idx, weights = table(size, yaw, pitch, fov, w, h)
+    xys = sorted(tiles)
+    stack = np.array([np.asarray(tiles[xy].convert('RGB')) for xy in xys])
+
+    # Tile coordinates to index into the stack of tiles
+    W, H = size
+    slots = np.full(((W - 1) // tile + 1, (H - 1) // tile + 1), -1, dtype=np.int64)
+    for j, (x, y) in enumerate(xys):
+        slots[x, y] = j
+
+    out = np.zeros((w*h, 3), dtype=np.float32)
+    for j in range(4):
+        x, y = idx[j] % W, idx[j] // W
+        slot = slots[x // tile, y // tile]
+        if (slot < 0).any():
+            raise KeyError('Tile needed by the view is missing')
+        out += stack[slot, y % tile, x % tile] * weights[j][:, None]
+    out = np.clip(out + .5, 0, 255).astype(np.uint8)
+    return Image.fromarray(out.reshape(h, w, 3))
+
+
+def cubemap(img, size=512, faces=None):
+    """
+    Cube map faces of the panorama.
+    :param img: Image - spherical panorama
+    :param size: int - face width and height
+    :param faces: string iterable - subset of FACES, default all
+    :return: OrderedDict - {face: Image}
+    """
+    faces = faces or FACES.keys()
+    return OrderedDict((face, perspective(img, FACES[face][0], FACES[face][1],
+                                          90, (size, size)))
+                       for face in faces)
+
+
+def cubeName(zoom, face):
+    """ Storage member name of a cube map face """
+    return 'zoom_%d_cube_%s.jpg' % (zoom, face)
+
+
+def encode(img):
+    """
+    :param img: Image
+    :return: string - JPEG data
+    """
+    buf = BytesIO()
+    img.save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+def dumpCubemap(img, zoom, size=512):
+    """
+    Cube map faces encoded for a storage.
+    :param img: Image - spherical panorama at the zoom level
+    :param zoom: int [0-5] - zoom level of img
+    :return: list of tuples (member, JPEG data)
+    """
+    return [(cubeName(zoom, face), encode(face_img))
+            for face, face_img in cubemap(img, size).items()]
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import logging
+from io import BytesIO
+from itertools import islice
+from multiprocessing import Pool
+from PIL import Image
+from panorama import Panorama
+import render
+from storage import openStorage, MetaStore
+from manifest import Manifest
+
+loger = logging.getLogger('reprocess')
+loger.setLevel(logging.WARNING)
+
+'''
+Offline reprocessing of a downloaded data set. Derived outputs
+(depth images, point clouds, lower zoom images, cube map faces,
+compact metadata)
+are regenerated from the stored raw data, no network is used.
+Outputs that exist and are newer than their source are skipped.
+'''
+
+
+def isCurrent(storage, pano_id, out, src):
+    """
+    Output is current if it exists and it is not older than its
+    source. Storages without modification times only check existence.
+    """
+    if not storage.has(pano_id, out):
+        return False
+    mtime = getattr(storage, 'mtime', None)
+    if not mtime or not src or not storage.has(pano_id, src):
+        return True
+    return mtime(pano_id, out) >= mtime(pano_id, src)
+
+
+def plan(storage, pano_id, rec, zoom, depth, points, compact, cube=None):
+    """
+    Decides which outputs of the panorama are missing or outdated
+    and reads the inputs needed to make them.
+    :return: tuple - job for work() or None if all is current
+    """
+    has = lambda member: storage.has(pano_id, member)
+    msrc = None if rec else 'meta.json'
+    dsrc = 'depth.json' if has('depth.json') else msrc
+
+    outputs = []
+    if depth and not isCurrent(storage, pano_id, 'zoom_0_depth.jpg', dsrc):
+        outputs.append(('zoom_0_depth.jpg', dsrc))
+    if points and not isCurrent(storage, pano_id, 'depth_points.ply', dsrc):
+        outputs.append(('depth_points.ply', dsrc))
+
+    # Lower zoom from the closest higher zoom image
+    stored = [z for z in range(6) if has('zoom_%d.jpg' % z)]
+    for z in zoom:
+        higher = [x for x in stored if x > z]
+        if not higher:
+            continue
+        src = 'zoom_%d.jpg' % min(higher)
+        if not isCurrent(storage, pano_id, 'zoom_%d.jpg' % z, src):
+            outputs.append(('zoom_%d.jpg' % z, src))
+
+    # Cube map from the highest zoom image
+    if cube and stored:
+        src = 'zoom_%d.jpg' % max(stored)
+        for face in render.FACES:
+            out = render.cubeName(max(stored), face)
+            if not isCurrent(storage, pano_id, out, src):
+                outputs.append((out, src))
+
+    if not outputs and not compact:
+        return None
+
+    inputs = dict()
+    if rec:
+        inputs['meta'], inputs['time_meta'] = rec['meta'], rec['time_meta']
+    else:
+        inputs['meta'] = json.loads(storage.read(pano_id, 'meta.json'))
+        if compact and has('time_meta.json'):
+            inputs['time_meta'] = json.loads(storage.read(pano_id, 'time_meta.json'))
+    if has('depth.json'):
+        inputs['depth.json'] = storage.read(pano_id, 'depth.json')
+    for _, src in outputs:
+        if src.endswith('.jpg'):
+            inputs[src] = storage.read(pano_id, src)
+
+    return pano_id, inputs, outputs, compact, cube
+
+
+def work(job):
+    """
+    Makes outputs of a single panorama, runs in a worker process.
+    :return: tuple - (pano_id, [(member, data)], compact record, error)
+    """
+    pano_id, inputs, outputs, compact, cube = job
+    p = Panorama()
+    p.pano_id = pano_id
+    p.meta = inputs.get('meta')
+    p.time_meta = inputs.get('time_meta')
+    if 'depth.json' in inputs:
+        p.depthdata = tuple(json.loads(inputs['depth.json']))
+
+    results = []
+    err = None
+    imgs = dict()                       # decoded sources
+    for out, src in outputs:
+        try:
+            if out == 'zoom_0_depth.jpg':
+                data = p.dumpDepthImage(0)
+            elif out == 'depth_points.ply':
+                data = p.dumpPointCloud()
+            elif '_cube_' in out:
+                if src not in imgs:
+                    imgs[src] = Image.open(BytesIO(inputs[src]))
+                face = out[:-len('.jpg')].rsplit('_', 1)[1]
+                data = render.encode(render.cubemap(imgs[src], cube, [face])[face])
+            else:
+                z = int(out[len('zoom_'):-len('.jpg')])
+                img = Image.open(BytesIO(inputs[src]))
+                img = img.resize(p.cropSize(z)[2:], Image.ANTIALIAS)
+                data = render.encode(img)
+            results.append((out, data))
+        except Exception as e:
+            err = '%s %s - %s: %s' % (pano_id, out, type(e).__name__, str(e))
+
+    record = None
+    if compact:
+        meta = p.getMetaNoDepth() if 'depth.json' in inputs else p.meta
+        record = (pano_id, meta, p.time_meta)
+    return pano_id, results, record, err
+
+
+def reprocess(root, zoom=(), depth=False, points=False, compact=False,
+              n_proc=4, chunk=64, cube=None):
+    """
+    Regenerates derived outputs of the data set in a pool of processes.
+    :param root: string - data set directory DIR/LABEL
+    :param zoom: int iterable - zoom levels to make from higher zooms
+    :param depth: boolean - depth images
+    :param points: boolean - depth point clouds
+    :param compact: boolean - compact metadata from meta JSON files
+    :param n_proc: int - number of processes
+    :param chunk: int - panoramas per process handed over at once
+    :param cube: int - cube map face size, faces are rendered from
+                 the highest zoom image
+    :return: tuple - (# panoramas processed, # outputs written)
+    """
+    storage = openStorage(root)
+    manifest = Manifest(root)               # outputs are recorded as crawled ones
+
+    # Compact data set has no meta files, records are the source
+    if os.path.isdir(os.path.join(root, 'meta')) and not compact:
+        source = ((rec['pano_id'], rec) for rec in MetaStore(root))
+    else:
+        source = ((pano_id, None) for pano_id in storage.panoIds())
+
+    metastore, done = None, set()
+    if compact:
+        metastore = MetaStore(root, manifest.add)
+        done = set(rec['pano_id'] for rec in metastore)
+
+    def jobs():
+        for pano_id, rec in source:
+            job = plan(storage, pano_id, rec, zoom, depth, points,
+                       compact and pano_id not in done, cube)
+            if job:
+                yield job
+
+    pool = Pool(n_proc)
+    n_pano, n_out, t0, tl = 0, 0, time.time(), time.time()
+    try:
+        it = jobs()
+        while True:
+            batch = list(islice(it, chunk * n_proc))
+            if not batch:
+                break
+            for pano_id, results, record, err in pool.imap_unordered(work, batch, chunk // 4 or 1):
+                if err:
+                    loger.error(err)
+                for member, data in results:
+                    storage.write(pano_id, member, data)
+                    manifest.add(pano_id, member, data)
+                if record:
+                    metastore.add(*record)
+                n_pano += 1
+                n_out += len(results)
+
+            if time.time() - tl > 5:
+                tl = time.time()
+                print 'Reprocessed: %06d panoramas\t %06d outputs\t %.1f/s' % \
+                      (n_pano, n_out, n_pano / (tl - t0))
+    finally:
+        pool.close()
+        pool.join()
+        if metastore:
+            metastore.close()
+        storage.close()
+        manifest.close()
+
+    return n_pano, n_out
@@ -0,0 +1,371 @@
+import os
+import json
+import time
+import Queue
+import logging
+import threading
+from collections import OrderedDict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import validator
+import hosts
+from crawler import Crawler
+from database import InFlight
+from panorama import timegroups
+
+loger = logging.getLogger('service')
+loger.setLevel(logging.INFO)
+
+'''
+Long-running crawling service. Area jobs are submitted and controlled
+over a local HTTP API, all jobs share one pool of crawling threads,
+one panorama cache and the panoramas fetched by the other jobs. Each
+job writes its own data set DIR/LABEL exactly as a single crawl does.
+
+GET  /jobs                  status of all jobs
+GET  /jobs/LABEL            status of a job
+POST /jobs                  submits a job, JSON body see Job
+POST /jobs/LABEL/pause      stops scheduling panoramas of the job
+POST /jobs/LABEL/resume     continues a paused job
+GET  /stats                 shared cache and host statistics
+'''
+
+
+class PanoCache:
+    """
+    Recently fetched panoramas shared by the jobs, the least
+    recently used are dropped when there are more than n_max.
+    """
+    n_max = 512
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.d = OrderedDict()
+        self.n_hits = 0
+
+    def get(self, pano_id):
+        with self.lock:
+            p = self.d.pop(pano_id, None)
+            if p is not None:
+                self.d[pano_id] = p
+                self.n_hits += 1
+            return p
+
+    def put(self, pano_id, p):
+        with self.lock:
+            self.d[pano_id] = p
+            while len(self.d) > self.n_max:
+                self.d.popitem(last=False)
+
+
+class Job(Crawler):
+    """
+    Crawler of a single area run by the service threads. Panoramas
+    come from the shared cache and members saved by other jobs are
+    copied instead of downloaded.
+
+    JSON spec of a job, 'label' and the area are required:
+    {"label": "praha", "area": "circle", "latlng": [50.08, 14.41], "r": 500}
+    area 'circle' needs "r", 'box' needs "w", "h", 'gpsbox' needs
+    "topleft", "btmright". Start is "latlng" or "pano_id", other keys
+    are Crawler parameters: zoom, images, depth, time, points, raw,
+    compact, shard_size, cube, sample, quota, seeds, grid.
+    """
+    options = ('zoom', 'images', 'depth', 'time', 'points', 'raw', 'compact',
+               'shard_size', 'cube', 'sample', 'quota', 'seeds', 'grid')
+
+    def __init__(self, service, spec):
+        self.service = service
+        self.spec = spec
+        self.label = spec['label']
+        self.state = 'running'          # 'paused', 'done'
+        self.hold = False               # not scheduled while checkpointing
+        self.t_save = time.time()
+        self.n_copied = 0
+
+        unknown = set(spec) - set(self.options) - \
+            set(['label', 'area', 'latlng', 'pano_id', 'r', 'w', 'h', 'topleft', 'btmright'])
+        if unknown:
+            raise ValueError('Unknown job keys: ' + ', '.join(sorted(unknown)))
+
+        latlng = tuple(spec['latlng']) if spec.get('latlng') else None
+        area = spec.get('area')
+        if area == 'circle':
+            pvalid = validator.circle(latlng, float(spec['r']))
+        elif area == 'box':
+            pvalid = validator.box(latlng, float(spec['w']), float(spec['h']))
+        elif area == 'gpsbox':
+            pvalid = validator.gpsbox(tuple(spec['topleft']), tuple(spec['btmright']))
+        else:
+            raise ValueError('Unknown area ' + str(area))
+
+        kwargs = dict((k, spec[k]) for k in self.options if k in spec)
+        Crawler.__init__(self, latlng=latlng, pano_id=spec.get('pano_id'),
+                         validator=pvalid, root=service.root, label=self.label,
+                         **kwargs)
+        self.inflight = service.inflight
+
+    def fetchPano(self, pano_id):
+        cache = self.service.cache
+        p = cache.get(pano_id)
+        if p is None:
+            p = Crawler.fetchPano(self, pano_id)
+            cache.put(pano_id, p)
+        return p
+
+    def has(self, pano_id, member):
+        """
+        Checks whether the member is saved, a member saved by
+        another job is copied into this data set.
+        """
+        if Crawler.has(self, pano_id, member):
+            return True
+        if member == 'meta.jsonl':
+            return False                # compact records are not members
+        for job in self.service.peers(self):
+            if job.manifest.has(pano_id, member):
+                try:
+                    self.copy(job, pano_id, member)
+                    return True
+                except Exception as e:
+                    loger.error('%s %s copy from %s failed - %s: %s' % (
+                        pano_id, member, job.label, type(e).__name__, str(e)))
+        return False
+
+    def copy(self, job, pano_id, member):
+        # Raw tiles are copied along with their layout
+        if member.endswith('_layout.json'):
+            layout = json.loads(job.storage.read(pano_id, member))
+            tw, th = layout['tiles']
+            for x in range(tw):
+                for y in range(th):
+                    name = layout['tile_name'].format(x=x, y=y)
+                    self.storage.write(pano_id, name, job.storage.read(pano_id, name))
+        self.storage.write(pano_id, member, job.storage.read(pano_id, member))
+        self.n_copied += 1
+
+    def status(self):
+        return {
+            'label':    self.label,
+            'state':    self.state,
+            'visited':  self.db.dsize(),
+            'queued':   self.db.qsize(),
+            'dup':      self.db.n_dup,
+            'copied':   self.n_copied,
+            'spec':     self.spec,
+        }
+
+
+class Service:
+    """
+    Schedules panoramas of all running jobs in round robin
+    over one pool of n_thr threads.
+    """
+    t_idle = .2                 # wait when no job has queued panoramas
+    t_save = 600                # checkpoint of each job every 10min
+
+    def __init__(self, root, n_thr=16):
+        self.root = root
+        self.n_thr = n_thr
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()       # {label: Job}
+        self.inflight = InFlight()
+        self.cache = PanoCache()
+        self.n_next = 0
+        self.exit_flag = False
+        self.threads = []
+
+    def submit(self, spec):
+        """
+        Starts a new job, an existing data set of the label is resumed.
+        :param spec: dictionary - see Job
+        :return: Job
+        """
+        label = spec.get('label')
+        if not label or os.path.basename(label) != label:
+            raise ValueError('Invalid label %r' % (label,))
+        with self.lock:
+            if label in self.jobs and self.jobs[label].state != 'done':
+                raise ValueError('Job %s already running' % label)
+        job = Job(self, spec)
+        with self.lock:
+            self.jobs[label] = job
+            timegroups.enabled = any(j.time for j in self.jobs.values())
+        loger.info('job %s submitted' % label)
+        return job
+
+    def all(self):
+        with self.lock:
+            return self.jobs.values()
+
+    def peers(self, job):
+        return [j for j in self.all() if j is not job]
+
+    def job(self, label):
+        with self.lock:
+            if label not in self.jobs:
+                raise KeyError(label)
+            return self.jobs[label]
+
+    def pause(self, label):
+        job = self.job(label)
+        if job.state == 'running':
+            job.state = 'paused'
+
+    def resume(self, label):
+        job = self.job(label)
+        if job.state == 'paused':
+            job.state = 'running'
+
+    def next(self):
+        """
+        Dequeues a panorama of the next running job in turn.
+        :return: tuple (job, pano_id) or (None, None)
+        """
+        with self.lock:
+            jobs = self.jobs.values()
+            for j in range(len(jobs)):
+                job = jobs[(self.n_next + j) % len(jobs)]
+                if job.state != 'running' or job.hold:
+                    continue
+                try:
+                    pano_id = job.db.dequeue(False)
+                except Queue.Empty:
+                    continue
+                self.n_next = (self.n_next + j + 1) % len(jobs)
+                return job, pano_id
+        return None, None
+
+    def worker(self):
+        while not self.exit_flag:
+            job, pano_id = self.next()
+            if job is None:
+                time.sleep(self.t_idle)
+                continue
+            try:
+                job.process(pano_id)
+            except Exception as e:
+                loger.error('%s %s - %s: %s' % (job.label, pano_id, type(e).__name__, str(e)))
+            finally:
+                job.db.task_done()
+
+    def hold(self, job):
+        """ Waits until no panorama of the job is in progress """
+        with self.lock:                 # no dequeue in progress
+            job.hold = True
+        while job.db.active > 0:
+            time.sleep(.05)
+
+    def checkpoint(self, job):
+        self.hold(job)
+        try:
+            job.checkpoint()
+        finally:
+            job.hold = False
+        job.t_save = time.time()
+
+    def maintain(self):
+        """ Finishes completed jobs and checkpoints the others """
+        for job in self.all():
+            if job.state == 'done':
+                continue
+            if job.db.isCompleted():
+                self.hold(job)
+                job.state = 'done'
+                job.close()
+                loger.info('job %s done, %d panoramas' % (job.label, job.db.dsize()))
+            elif time.time() - job.t_save > self.t_save:
+                self.checkpoint(job)
+
+    def stats(self):
+        return {
+            'shared':       self.inflight.n_shared,
+            'cache_hits':   self.cache.n_hits,
+            'tm_saved':     timegroups.n_saved,
+            'hosts':        hosts.summary(),
+        }
+
+    def run(self, port=8080, host='127.0.0.1'):
+        """
+        Serves the control API until KeyboardInterrupt, then all
+        jobs are checkpointed.
+        """
+        for _ in range(self.n_thr):
+            t = threading.Thread(target=self.worker)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.service = self
+        t = threading.Thread(target=server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        print 'Serving on http://%s:%d/jobs' % (host, port)
+
+        try:
+            while True:
+                self.maintain()
+                time.sleep(5)
+        except (KeyboardInterrupt, SystemExit):
+            loger.debug('*** handling keyboard or system interrupt')
+        finally:
+            print 'Stopping jobs and saving.... please wait.'
+            server.shutdown()
+            self.exit_flag = True
+            for t in self.threads:
+                t.join()
+            for job in self.all():
+                if job.state != 'done':
+                    job.close()
+            print 'Done'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    def reply(self, code, obj):
+        body = json.dumps(obj, indent=2)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_any(self, method):
+        service = self.server.service
+        parts = [x for x in self.path.split('?')[0].split('/') if x]
+        try:
+            if method == 'GET' and parts == ['jobs']:
+                return self.reply(200, [j.status() for j in service.all()])
+            if method == 'GET' and parts == ['stats']:
+                return self.reply(200, service.stats())
+            if method == 'GET' and len(parts) == 2 and parts[0] == 'jobs':
+                return self.reply(200, service.job(parts[1]).status())
+            if method == 'POST' and parts == ['jobs']:
+                size = int(self.headers.getheader('Content-Length') or 0)
+                spec = json.loads(self.rfile.read(size))
+                return self.reply(201, service.submit(spec).status())
+            if method == 'POST' and len(parts) == 3 and parts[0] == 'jobs' \
+                    and parts[2] in ('pause', 'resume'):
+                getattr(service, parts[2])(parts[1])
+                return self.reply(200, service.job(parts[1]).status())
+            self.reply(404, {'error': 'Unknown request %s %s' % (method, self.path)})
+        except KeyError as e:
+            self.reply(404, {'error': 'Unknown job %s' % str(e)})
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+        except Exception as e:
+            loger.error('%s %s - %s: %s' % (method, self.path, type(e).__name__, str(e)))
+            self.reply(500, {'error': '%s: %s' % (type(e).__name__, str(e))})
+
+    def do_GET(self):
+        self.handle_any('GET')
+
+    def do_POST(self):
+        self.handle_any('POST')
+
+    def log_message(self, fmt, *args):
+        loger.info(fmt % args)
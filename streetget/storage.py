@@ -0,0 +1,467 @@
+import os
+import json
+import shutil
+import gzip
+import tarfile
+import threading
+import time
+import logging
+from io import BytesIO
+from collections import deque
+
+loger = logging.getLogger('storage')
+loger.setLevel(logging.WARNING)
+
+'''
+A storage keeps members of panoramas, e.g. 'meta.json' or
+'zoom_5.jpg', as raw strings of bytes. Members are addressed
+by the pano_id and the member name.
+'''
+
+
+class FileStorage:
+    """
+    Each member is saved as a single file DIR/_xx/<pano_id>_<member>
+    where 'xx' are the first two characters of the pano_id hash.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.dirs = set()               # directories known to exist
+        self.unsynced = []              # files written since last sync()
+
+    def path(self, pano_id, member):
+        pdir = os.path.join(self.root, '_' + pano_id[0:2])
+        return os.path.join(pdir, pano_id + '_' + member)
+
+    def write(self, pano_id, member, data):
+        fname = self.path(pano_id, member)
+        pdir = os.path.dirname(fname)
+        if pdir not in self.dirs:
+            try:
+                os.makedirs(pdir)
+            except OSError:
+                if not os.path.isdir(pdir):
+                    raise
+            self.dirs.add(pdir)
+        with open(fname, 'wb') as f:
+            f.write(data)
+        self.unsynced.append(fname)
+
+    def read(self, pano_id, member):
+        with open(self.path(pano_id, member), 'rb') as f:
+            return f.read()
+
+    def has(self, pano_id, member):
+        return os.path.exists(self.path(pano_id, member))
+
+    def mtime(self, pano_id, member):
+        return os.path.getmtime(self.path(pano_id, member))
+
+    def size(self, pano_id, member):
+        return os.path.getsize(self.path(pano_id, member))
+
+    def panoIds(self):
+        """ Lists pano_ids of saved panoramas, given by their meta files """
+        for pdir in sorted(os.listdir(self.root)):
+            if not pdir.startswith('_') or not os.path.isdir(os.path.join(self.root, pdir)):
+                continue
+            for fname in sorted(os.listdir(os.path.join(self.root, pdir))):
+                if fname.endswith('_meta.json') and not fname.endswith('_time_meta.json'):
+                    yield fname[:-len('_meta.json')]
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        """ Forces files written since the last call to disk """
+        fnames, self.unsynced = self.unsynced, []
+        for fname in fnames:
+            fd = os.open(fname, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        self.sync()
+
+
+class TileStore:
+    """
+    Image tiles of panorama downloads in progress, each tile is a file
+    DIR/partial/<pano_id>/zoom_Z_X_Y.jpg. Tiles of an interrupted or
+    failed download are kept, so only the missing ones are fetched
+    again. Panoramas of less than n_min tiles are not kept.
+    """
+    n_min = 32
+
+    def __init__(self, root):
+        self.dir = os.path.join(root, 'partial')
+
+    def path(self, pano_id, zoom, x, y):
+        return os.path.join(self.dir, pano_id, 'zoom_%d_%d_%d.jpg' % (zoom, x, y))
+
+    def read(self, pano_id, zoom, x, y):
+        """ :return: string - JPEG data or None """
+        try:
+            with open(self.path(pano_id, zoom, x, y), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def write(self, pano_id, zoom, x, y, data):
+        fname = self.path(pano_id, zoom, x, y)
+        pdir = os.path.dirname(fname)
+        try:
+            os.makedirs(pdir)
+        except OSError:
+            if not os.path.isdir(pdir):
+                raise
+        with open(fname + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(fname + '.tmp', fname)        # tile is complete or missing
+
+    def remove(self, pano_id):
+        """ Removes tiles of the panorama once its images are saved """
+        shutil.rmtree(os.path.join(self.dir, pano_id), ignore_errors=True)
+
+    def clear(self, keep=()):
+        """
+        Removes tiles of all panoramas except those in keep.
+        :param keep: string container - pano_ids of unfinished panoramas
+        """
+        if not keep:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            return
+        if os.path.isdir(self.dir):
+            for pano_id in os.listdir(self.dir):
+                if pano_id not in keep:
+                    self.remove(pano_id)
+
+
+class ShardStorage:
+    """
+    Members are appended to tar archive shards DIR/shards/shard_NNNNN.tar
+    of the size about shard_size bytes. Member names inside the archive
+    follow the FileStorage layout. Offsets of the members are kept in
+    the append-only index DIR/shards/index.txt, one member per line:
+    pano_id member shard offset size
+    Hence any member can be read by pano_id without scanning the shards.
+    """
+    def __init__(self, root, shard_size=1024**3):
+        self.dir = os.path.join(root, 'shards')
+        self.fname_idx = os.path.join(self.dir, 'index.txt')
+        self.shard_size = shard_size
+        self.lock = threading.Lock()
+        self.index = dict()             # {pano_id: {member: (shard, offset, size)}}
+        self.n_shard = -1
+        self.tar = None
+
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        if os.path.exists(self.fname_idx):
+            self.loadIndex()
+        self.f_idx = open(self.fname_idx, 'a')
+
+    def loadIndex(self):
+        with open(self.fname_idx) as f:
+            for line in f:
+                item = line.split()
+                if len(item) != 5:
+                    continue                    # incomplete last line
+                pano_id, member = item[0], item[1]
+                shard, offset, size = map(int, item[2:])
+                self.index.setdefault(pano_id, dict())[member] = (shard, offset, size)
+                self.n_shard = max(self.n_shard, shard)
+
+    def shardName(self, shard):
+        return os.path.join(self.dir, 'shard_%05d.tar' % shard)
+
+    def nextShard(self):
+        """
+        Closes current shard and opens a new one. A shard that was open
+        during a crash is never appended, writing continues in a new one.
+        """
+        if self.tar:
+            self.tar.close()
+        self.n_shard += 1
+        self.tar = tarfile.open(self.shardName(self.n_shard), 'w')
+        loger.info('shard %d opened' % self.n_shard)
+
+    def write(self, pano_id, member, data):
+        name = '_%s/%s_%s' % (pano_id[0:2], pano_id, member)
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+
+        with self.lock:
+            if not self.tar or self.tar.offset >= self.shard_size:
+                self.nextShard()
+
+            header = info.tobuf(self.tar.format, self.tar.encoding, self.tar.errors)
+            offset = self.tar.offset + len(header)
+            self.tar.addfile(info, BytesIO(data))
+            self.tar.fileobj.flush()
+
+            # Index line is written after its data
+            self.f_idx.write('%s %s %d %d %d\n' % (pano_id, member, self.n_shard, offset, info.size))
+            self.f_idx.flush()
+            self.index.setdefault(pano_id, dict())[member] = (self.n_shard, offset, info.size)
+
+    def read(self, pano_id, member):
+        shard, offset, size = self.index[pano_id][member]
+        with open(self.shardName(shard), 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def has(self, pano_id, member):
+        return member in self.index.get(pano_id, ())
+
+    def size(self, pano_id, member):
+        """ Size of a member, raises IOError if its shard is truncated """
+        shard, offset, size = self.index[pano_id][member]
+        if os.path.getsize(self.shardName(shard)) < offset + size:
+            raise IOError('shard %d truncated' % shard)
+        return size
+
+    def members(self, pano_id):
+        return self.index.get(pano_id, dict()).keys()
+
+    def panoIds(self):
+        return iter(sorted(self.index))
+
+    def flush(self):
+        with self.lock:
+            if self.tar:
+                self.tar.fileobj.flush()
+            self.f_idx.flush()
+
+    def sync(self):
+        """ Forces the current shard and the index to disk """
+        with self.lock:
+            if self.tar:
+                self.tar.fileobj.flush()
+                os.fsync(self.tar.fileobj.fileno())
+            self.f_idx.flush()
+            os.fsync(self.f_idx.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.tar:
+                self.tar.close()
+                self.tar = None
+            self.f_idx.close()
+
+
+def openStorage(root):
+    """
+    Opens storage of an existing data set DIR/LABEL, sharded if
+    the data set contains shards, otherwise small files.
+    """
+    if os.path.exists(os.path.join(root, 'shards', 'index.txt')):
+        return ShardStorage(root)
+    return FileStorage(root)
+
+
+class WriteError(IOError):
+    """
+    Members queued in AsyncWriter failed to be written.
+    pano_ids - set of panoramas of the failed members
+    """
+    def __init__(self, msg, pano_ids):
+        IOError.__init__(self, msg)
+        self.pano_ids = pano_ids
+
+
+class AsyncWriter:
+    """
+    Hands members over to a storage written by a dedicated thread,
+    so crawler threads do not wait for the disk. Queued data are
+    bounded to buf_size bytes, write() blocks only if the buffer is
+    full. The storage is synced every n_sync members or t_sync seconds.
+    Optional callback(pano_id, member, data) is called after a member
+    has been written. A failed write is raised as WriteError from the
+    next write(), flush() or close().
+    """
+    def __init__(self, storage, buf_size=256*1024**2, n_sync=500, t_sync=30,
+                 callback=None):
+        self.storage = storage
+        self.callback = callback
+        self.buf_size = buf_size
+        self.n_sync = n_sync
+        self.t_sync = t_sync
+
+        self.cond = threading.Condition()
+        self.q = deque()
+        self.pending = dict()           # {(pano_id, member): data} not written yet
+        self.size = 0                   # bytes queued or being written
+        self.busy = False
+        self.stopped = False
+        self.error = None               # first write error not raised yet
+        self.failed = set()             # pano_ids of failed members
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def check(self):
+        """ Raises WriteError if members failed to be written """
+        with self.cond:
+            if self.error is None:
+                return
+            msg = '%d panoramas not written, first error: %s' % (len(self.failed), self.error)
+            e = WriteError(msg, self.failed)
+            self.error, self.failed = None, set()
+        raise e
+
+    def write(self, pano_id, member, data):
+        self.check()
+        with self.cond:
+            while self.size > 0 and self.size + len(data) > self.buf_size:
+                self.cond.wait()
+            self.q.append((pano_id, member, data))
+            self.pending[(pano_id, member)] = data
+            self.size += len(data)
+            self.cond.notify_all()
+
+    def read(self, pano_id, member):
+        with self.cond:
+            data = self.pending.get((pano_id, member))
+        if data is not None:
+            return data
+        return self.storage.read(pano_id, member)
+
+    def has(self, pano_id, member):
+        with self.cond:
+            if (pano_id, member) in self.pending:
+                return True
+        return self.storage.has(pano_id, member)
+
+    def run(self):
+        n, t = 0, time.time()
+        while True:
+            with self.cond:
+                if not self.q and not self.stopped:
+                    self.cond.wait(self.t_sync)
+                if not self.q and self.stopped:
+                    break
+                item = self.q.popleft() if self.q else None
+                self.busy = item is not None
+
+            if item:
+                pano_id, member, data = item
+                try:
+                    self.storage.write(pano_id, member, data)
+                    n += 1
+                    if self.callback:
+                        self.callback(pano_id, member, data)
+                except Exception as e:
+                    msg = '%s %s write failed - %s: %s' % (
+                        pano_id, member, type(e).__name__, str(e))
+                    loger.error(msg)
+                    with self.cond:
+                        self.error = self.error or msg
+                        self.failed.add(pano_id)
+
+                with self.cond:
+                    if self.pending.get((pano_id, member)) is data:
+                        del self.pending[(pano_id, member)]
+                    self.size -= len(data)
+                    self.busy = False
+                    self.cond.notify_all()
+
+            if n >= self.n_sync or (n and time.time() - t > self.t_sync):
+                self._sync()
+                n, t = 0, time.time()
+        self._sync()
+
+    def _sync(self):
+        try:
+            self.storage.sync()
+        except Exception as e:
+            loger.error('sync failed - %s: %s' % (type(e).__name__, str(e)))
+
+    def flush(self):
+        """ Blocks until all queued data are written """
+        with self.cond:
+            while self.q or self.busy:
+                self.cond.wait()
+        self.storage.flush()
+        self.check()
+
+    def sync(self):
+        self.flush()
+        self.storage.sync()
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.storage.close()
+        self.check()
+
+
+class MetaStore:
+    """
+    Compact metadata store. Records {'pano_id', 'meta', 'time_meta'}
+    are buffered and written as gzip compressed JSON lines in batches,
+    one batch per file DIR/meta/meta_NNNNN.jsonl.gz
+    Optional callback(pano_id, 'meta.jsonl', record) is called for
+    each record of a written batch.
+    """
+    n_buf = 1000
+
+    def __init__(self, root, callback=None):
+        self.callback = callback
+        self.dir = os.path.join(root, 'meta')
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        self.lock = threading.Lock()
+        self.records = []
+        self.n_batch = len(self.batches())
+
+    def batches(self):
+        names = [x for x in os.listdir(self.dir) if x.endswith('.jsonl.gz')]
+        return [os.path.join(self.dir, x) for x in sorted(names)]
+
+    def add(self, pano_id, meta, time_meta):
+        rec = json.dumps({'pano_id': pano_id, 'meta': meta, 'time_meta': time_meta},
+                         separators=(',', ':'))
+        with self.lock:
+            self.records.append((pano_id, rec))
+            if len(self.records) >= self.n_buf:
+                self._write()
+
+    def _write(self):
+        if not self.records:
+            return
+        fname = os.path.join(self.dir, 'meta_%05d.jsonl.gz' % self.n_batch)
+        f = gzip.open(fname + '.tmp', 'wb')
+        try:
+            f.write('\n'.join(rec for _, rec in self.records) + '\n')
+        finally:
+            f.close()
+        os.rename(fname + '.tmp', fname)       # batch is complete or missing
+        if self.callback:
+            for pano_id, rec in self.records:
+                self.callback(pano_id, 'meta.jsonl', rec)
+        self.n_batch += 1
+        self.records = []
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def close(self):
+        self.flush()
+
+    def __iter__(self):
+        """ Iterates over saved records """
+        for fname in self.batches():
+            f = gzip.open(fname, 'rb')
+            try:
+                for line in f:
+                    yield json.loads(line)
+            finally:
+                f.close()
@@ -0,0 +1,101 @@
+import threading
+import logging
+from Queue import Queue, Empty, Full
+from panorama import Panorama
+from database import Database, InFlight
+import depth as dpth
+
+loger = logging.getLogger('stream')
+loger.setLevel(logging.WARNING)
+
+
+def iterPanoramas(area, pano_id=None, latlng=None, zoom=(), depth=False,
+                  time=False, n_thr=4, lookahead=16):
+    """
+    Crawls panoramas inside the area and yields them as they are
+    fetched, nothing is written to disk. Crawling runs in n_thr
+    threads at most lookahead panoramas ahead of the consumer,
+    threads wait while the consumer is busy. Closing the generator
+    stops the crawling.
+    :param area: validator - e.g. validator.circle()
+    :param pano_id: string - starting panorama
+    :param latlng: tuple (lat, lng) - starting point, center of the
+                   area if neither pano_id nor latlng is given
+    :param zoom: int iterable - zoom levels of images to fetch
+    :param depth: boolean - fetch depth data and compute depth map
+    :param time: boolean - include temporal neighbours
+    :param n_thr: int - number of crawling threads
+    :param lookahead: int - max. number of panoramas waiting for consumer
+    :return: generator of Panorama objects, images at given zoom levels
+             are in p.images {zoom: JPEG data}, depth in p.depthdata and
+             p.depthmap
+    """
+    if not pano_id and not latlng:
+        (lt0, ln0), (lt1, ln1) = area.bbox
+        latlng = ((lt0 + lt1) / 2, (ln0 + ln1) / 2)
+
+    db = Database()
+    inflight = InFlight()
+    out = Queue(lookahead)
+    stop = threading.Event()
+
+    def visit(p):
+        if not (p and p.isValid() and area(p)):
+            return False
+        neighbours = p.getAllNeighbours() if time else p.getSpatialNeighbours()
+        for n in neighbours:
+            db.enqueue(n)
+        return not p.isCustom()
+
+    def fetch(p):
+        p.images = dict((z, p.dumpImage(z)) for z in zoom if p.hasZoom(z))
+        if depth:
+            p.getDepthData()
+            p.depthmap = dpth.depthMap(p.depthdata)
+
+    def worker():
+        while not stop.is_set():
+            key = db.dequeue()
+            if db.isSentinel(key):
+                db.task_done()
+                return
+            try:
+                p = inflight.fetch(key, lambda: Panorama(key))
+                if visit(p):
+                    fetch(p)
+                    while not stop.is_set():
+                        try:
+                            out.put(p, timeout=.1)      # back-pressure
+                            break
+                        except Full:
+                            pass
+            except Exception as e:
+                msg = '%s - %s: %s' % (key, type(e).__name__, str(e))
+                loger.error(msg)
+            finally:
+                db.task_done()
+
+    start = Panorama(pano_id, latlng)
+    if not start.pano_id:
+        return
+    db.enqueue(start.pano_id)
+
+    threads = [threading.Thread(target=worker) for _ in range(n_thr)]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+
+    try:
+        while True:
+            try:
+                yield out.get(timeout=.1)
+            except Empty:
+                # Items are queued before the task is done
+                if db.isCompleted() and out.empty():
+                    break
+    finally:
+        stop.set()
+        for _ in threads:
+            db.prependSentinel()
+        for t in threads:
+            t.join()
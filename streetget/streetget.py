@@ -1,12 +1,22 @@
 #! /usr/bin/python
 """
 Usage:
-    streetget circle ( (LAT LNG) | PID) R [-tid -D DIR -z ZOOM] LABEL
-    streetget box ( (LAT LNG) | PID) W H [-tid -D DIR -z ZOOM] LABEL
+    streetget circle ( (LAT LNG) | PID) R [-tidmrpUV -D DIR -z ZOOM -a SIZE -s FILE -g STEP -H FILE -c SIZE -q CELL -Q N] LABEL
+    streetget box ( (LAT LNG) | PID) W H [-tidmrpUV -D DIR -z ZOOM -a SIZE -s FILE -g STEP -H FILE -c SIZE -q CELL -Q N] LABEL
     streetget gpsbox LAT LNG LAT_TL LNG_TL LAT_BR LNG_BR [options] LABEL
     streetget resume [-D DIR] LABEL
+    streetget reprocess [-dpm -D DIR -z ZOOM -j N -c SIZE] LABEL
     streetget info ( (LAT LNG) | PID)
     streetget show PID
+    streetget view PID [-z ZOOM --yaw DEG --pitch DEG --fov DEG --size WxH --link N] FILE
+    streetget lookup [--radius M --threads N --format FMT -H FILE] FILE
+    streetget serve [-D DIR -H FILE --port N --threads N]
+    streetget estimate circle LAT LNG R [-tid -z ZOOM -b N -H FILE --threads N]
+    streetget estimate box LAT LNG W H [-tid -z ZOOM -b N -H FILE --threads N]
+    streetget estimate gpsbox LAT_TL LNG_TL LAT_BR LNG_BR [-tid -z ZOOM -b N -H FILE --threads N]
+    streetget query [-D DIR -f DATE -u DATE] LABEL
+    streetget query LAT LNG R [-D DIR -f DATE -u DATE] LABEL
+    streetget query LAT_TL LNG_TL LAT_BR LNG_BR [-D DIR -f DATE -u DATE] LABEL
 
 Commands:
     circle              Downloads street-view inside circular area
@@ -22,10 +32,44 @@ Commands:
                         directory flag -D DIR is allowed. Other
                         flags will be restored from the interrupted
                         session.
+    reprocess           Regenerates derived data of the data set LABEL
+                        from already downloaded data, no download.
+                        Makes depth images with -d, point clouds
+                        with -p, lower zoom images from higher zoom
+                        images with -z, cube map faces with -c and
+                        compact metadata from JSON files with -m.
+                        Current outputs are
+                        skipped.
     info                Prints info about the closest panorama at LAT,
                         LNG position or info about panorama id PID.
     show                Shows panorama image at zoom level 2 in default
                         python image browser.
+    view                Saves perspective view of panorama PID into
+                        JPEG FILE. Only image tiles covered by the view
+                        are downloaded, at the highest of -z levels.
+    lookup              Resolves GPS points of FILE to closest panorama
+                        ids concurrently. FILE has one 'LAT,LNG' per
+                        line, use - for standard input. Results are
+                        streamed in the input order.
+    serve               Runs crawling service, area jobs are submitted
+                        and controlled over HTTP API at localhost port
+                        N, e.g. POST /jobs with JSON {"label": "praha",
+                        "area": "circle", "latlng": [50.08, 14.41],
+                        "r": 500, "images": true}. All jobs share the
+                        crawling threads and panoramas fetched by
+                        other jobs. Data are saved in DIR/LABEL/
+    estimate            Estimates cost of crawling the area with the
+                        same -t, -i, -d and -z options. Metadata of
+                        random samples of the area are fetched within
+                        the request budget N of -b, the panorama
+                        density is extrapolated to the whole area.
+                        Prints expected number of panoramas, requests
+                        and storage per zoom level and depth data.
+    query               Lists panoramas of the data set LABEL within
+                        the radius R meters around LAT, LNG or inside
+                        GPS rectangle LAT_TL, LNG_TL, LAT_BR, LNG_BR,
+                        or all of them if no area is given.
+                        Uses the crawl index saved in DIR/LABEL/index/
 Arguments:
     LABEL               Data set label. Will be used as a directory name.
     LAT, LNG            Starting point latitude and longitude.
@@ -34,6 +78,7 @@ Arguments:
     PID                 Panorama id hash code.
     W, H                Width and height in meters.
     R                   Radius in meters.
+    FILE                Input file, output file of view.
 
 NOTE:
     A MINUS sign (dash) is NOT allowed for negative numbers. Instead use letter
@@ -43,15 +88,69 @@ Options:
     -t          Time machine, include temporal panorama neighbours.
     -i          Save images, if unset only metadata are fetched and saved.
     -d          Save depth data and depth map thumbnails at zoom level 0.
+                Depth map payload is then stripped from the metadata.
+    -p          Save depth point cloud depth_points.ply, float32 XYZ
+                of every depth map pixel in the camera frame.
+    -r          Raw tiles, original tile JPEGs are saved without
+                stitching and re-encoding, along with the layout
+                zoom_ZOOM_layout.json (tile grid and crop box).
+    -c SIZE     Save cube map faces SIZE x SIZE px rendered from the
+                highest zoom image, zoom_ZOOM_cube_FACE.jpg. Not
+                available with raw tiles.
+    -q CELL     Sampling crawl, metadata of all panoramas are saved but
+                images and depth only of the first panoramas found in
+                each grid cell of CELL x CELL meters.
+    -Q N        Number of sampled panoramas per cell [default: 1]
+    -s FILE     Seed the crawl also with pano_ids listed in FILE,
+                one per line.
+    -g STEP     Seed the crawl also from a grid of points STEP meters
+                apart over the whole area, points are resolved to the
+                closest panoramas.
+    -H FILE     Host pools configuration, JSON of endpoint (panoid, tile,
+                meta, photometa) to list of base URLs, e.g.
+                {"tile": ["https://geo0.ggpht.com/cbk", "http://my.proxy/cbk"]}
+    -U          Update existing data set LABEL, the area is crawled again
+                and only files missing in DIR/LABEL/manifest.txt are
+                fetched. Saved files are checked against their size
+                in the manifest first, corrupt files are fetched again.
+    -V          With -U, checksums of saved files are checked too,
+                all saved files are read.
+    -m          Compact metadata, records are saved gzip compressed in
+                batches into DIR/LABEL/meta/ instead of JSON files.
     -z ZOOM     Comma separated panorama zoom levels [0-5] to be
-                download [default: 0,5]
+                download, 0,5 if unset. Reprocess makes lower zoom
+                images only for levels given explicitly.
     -D DIR      Root directory. Data will be saved in DIR/LABEL/
                 [default: ./]
+    -a SIZE     Archive data into tar shards of SIZE MB, DIR/LABEL/shards/
+                with an index of member offsets, instead of saving
+                small files.
+    -j N        Number of reprocessing processes [default: 4]
+    -b N        Request budget of estimate [default: 500]
+    -f DATE     Query panoramas taken since DATE, format YYYY-MM.
+    -u DATE     Query panoramas taken until DATE, format YYYY-MM.
+    --radius M      Lookup search radius in meters [default: 15]
+    --threads N     Number of lookup, service or estimate threads [default: 16]
+    --port N        Service port [default: 8080]
+    --format FMT    Lookup output format 'csv' or 'json' [default: csv]
+    --yaw DEG       View direction, 0 is the panorama image center or
+                    the link direction with --link [default: 0]
+    --pitch DEG     View direction, 0 is the horizon [default: 0]
+    --fov DEG       View horizontal field of view [default: 90]
+    --size WxH      View size in pixels [default: 640x480]
+    --link N        Yaw is relative to the direction of the N-th link
+                    to an adjacent panorama, see info.
     -h, --help  Prints this screen.
 
 """
 import pickle
 import validator
+import index
+import lookup
+import reprocess
+import hosts
+import service
+import estimate
 import os
 import sys
 import logging
@@ -67,7 +166,19 @@ class Arguments:
     time = None
     images = None
     depth = None
+    compact = None
+    raw = None
+    seeds = None
+    points = None
+    cube = None
+    sample = None
+    quota = None
+    update = None
+    checksum = None
+    grid = None
+    hosts = None
     zoom = None
+    shard = None
     latlng = None
     panoid = None
     topleft = None
@@ -78,6 +189,15 @@ class Arguments:
     resume = None
     info = None
     show = None
+    view = None
+    query = None
+    serve = None
+    estimate = None
+    budget = None
+    lookup = None
+    reprocess = None
+    since = None
+    until = None
     pvalid = None
 
 def tofloat(s):
@@ -93,7 +213,22 @@ def tofloat(s):
         return float(s)
     return -float(s[1:])
 
+def todate(s):
+    """
+    String YYYY-MM to tuple (year, month). If input
+    is None it returns None.
+    :param s:
+    :return: tuple or None
+    """
+    if not s:
+        return None
+    year, month = s.split('-')
+    return int(year), int(month)
+
 def parse(a):
+    if a.hosts:
+        hosts.load(a.hosts)
+
     # Info command
     if a.info:
         # pano_id has priority over latlng
@@ -105,6 +240,40 @@ def parse(a):
         Panorama(pano_id=a.panoid).getImage(2).show()
         return
 
+    # View command
+    if a.view:
+        view(a)
+        return
+
+    # Lookup command
+    if a.lookup:
+        f = sys.stdin if a.fname == '-' else open(a.fname)
+        results = lookup.lookup(lookup.readPoints(f), a.radius, a.n_threads)
+        lookup.writeResults(results, sys.stdout, a.format)
+        return
+
+    # Query command
+    if a.query:
+        query(a)
+        return
+
+    # Service command
+    if a.serve:
+        if not os.path.exists(a.root):
+            os.makedirs(a.root)
+        logging.basicConfig(filename=os.path.join(a.root, 'service.log'),
+                            format='%(asctime)s %(levelname)s: %(message)s',
+                            datefmt='%m/%d/%Y %I:%M:%S %p')
+        service.Service(a.root, a.n_threads).run(a.port)
+        return
+
+    # Estimate command
+    if a.estimate:
+        res = estimate.estimate(area(a), a.zoom if a.images else (), a.depth,
+                                a.time, a.budget, a.n_threads)
+        print estimate.report(res)
+        return
+
     # Setting up loger
     fdir = os.path.join(a.root, a.label)
     if not os.path.exists(fdir):
@@ -114,6 +283,13 @@ def parse(a):
     l_fname = os.path.join(a.root, a.label, 'crawler.log')  # filepath
     logging.basicConfig(filename=l_fname, format=l_fmt, datefmt=l_dfmt)
 
+    # Reprocess command
+    if a.reprocess:
+        n_pano, n_out = reprocess.reprocess(fdir, a.zoom, a.depth, a.points,
+                                            a.compact, a.n_proc, cube=a.cube)
+        print 'Reprocessed %d panoramas, %d outputs written' % (n_pano, n_out)
+        return
+
     # Filename for command restore
     fname = os.path.join(a.root, a.label, 'crawlerArgs.pickle')
 
@@ -123,29 +299,60 @@ def parse(a):
             a = pickle.load(f)
         print '\nResuming command:'
         print a.cmds + '\n'
+        a.update = None             # update traversal is in the crawler db
+        if a.hosts:
+            hosts.load(a.hosts)
     else:
-        if os.path.exists(fname):
+        if os.path.exists(fname) and not a.update:
             msg = '\n"%s" already crawled. Use "resume" (see --help) to continue crawling.' % (a.label,)
             raise AssertionError(msg)
 
     # Create area validator for crawler
-    if a.circle:
-        pvalid = validator.circle(a.latlng, a.r)
-    elif a.box:
-        pvalid = validator.box(a.latlng, a.w, a.h)
-    elif a.gpsbox:
-        pvalid = validator.gpsbox(a.topleft, a.btmright)
-    else:
-        raise NotImplementedError('Unknown validator')
+    pvalid = area(a)
 
     with open(fname, 'w') as f:
         pickle.dump(a, f)
     launch(a, pvalid)
 
+def area(a):
+    if a.circle:
+        return validator.circle(a.latlng, a.r)
+    elif a.box:
+        return validator.box(a.latlng, a.w, a.h)
+    elif a.gpsbox:
+        return validator.gpsbox(a.topleft, a.btmright)
+    raise NotImplementedError('Unknown validator')
+
+def query(a):
+    fdir = os.path.join(a.root, a.label)
+    topleft = a.topleft if a.topleft[0] is not None else None
+    cols, idx = index.query(fdir, a.latlng, a.r, topleft, a.btmright,
+                            a.since, a.until)
+    for j in idx:
+        print '%s %.6f %.6f %d-%02d' % (
+            cols['pano_id'][j], cols['lat'][j], cols['lng'][j],
+            cols['year'][j], cols['month'][j]
+        )
+
+def view(a):
+    p = Panorama(pano_id=a.panoid)
+    if not p.isValid():
+        raise ValueError('Panorama %s not found' % a.panoid)
+    yaw = a.yaw
+    if a.link is not None:
+        yaw += p.getLinkYaw(a.link)
+    img = p.getView(yaw, a.pitch, a.fov, a.size, max(a.zoom))
+    img.save(a.fname, 'JPEG')
+
 def launch(a, pvalid):
     c = Crawler(pano_id=a.panoid, latlng=a.latlng, validator=pvalid,
                 label=a.label, root=a.root, zoom=a.zoom,
-                images=a.images, depth=a.depth, time=a.time
+                images=a.images, depth=a.depth, time=a.time,
+                shard_size=a.shard, compact=a.compact, raw=a.raw,
+                seeds=a.seeds, grid=a.grid, points=a.points,
+                update=a.update, cube=a.cube,
+                sample=a.sample, quota=a.quota or 1,
+                checksum=a.checksum
                 )
     c.run()
 
@@ -166,8 +373,23 @@ def main():
     # Image related stuff
     a.time = args['-t']
     a.images = args['-i']
-    a.zoom = map(lambda x: int(x), args['-z'].split(','))
+    zoom = args['-z'] or ('' if args['reprocess'] else '0,5')
+    a.zoom = [int(x) for x in zoom.split(',') if x]
     a.depth = args['-d']
+    a.compact = args['-m']
+    a.raw = args['-r']
+    a.points = args['-p']
+    a.update = args['-U']
+    a.checksum = args['-V']
+    a.cube = int(args['-c']) if args['-c'] else None
+    a.sample = tofloat(args['-q'])
+    a.quota = int(args['-Q'])
+    a.hosts = args['-H']
+    a.grid = tofloat(args['-g'])
+    if args['-s']:
+        with open(args['-s']) as f:
+            a.seeds = [x.strip() for x in f if x.strip()]
+    a.shard = int(float(args['-a']) * 1024**2) if args['-a'] else None
 
     # Area downloading stuff
     a.circle = args['circle']
@@ -178,6 +400,26 @@ def main():
     a.resume = args['resume']
     a.info = args['info']
     a.show = args['show']
+    a.view = args['view']
+    a.query = args['query']
+    a.lookup = args['lookup']
+    a.serve = args['serve']
+    a.estimate = args['estimate']
+    a.budget = int(args['-b'])
+    a.port = int(args['--port'])
+    a.reprocess = args['reprocess']
+    a.n_proc = int(args['-j'])
+    a.fname = args['FILE']
+    a.radius = float(args['--radius'])
+    a.n_threads = int(args['--threads'])
+    a.format = args['--format']
+    a.yaw = tofloat(args['--yaw'])
+    a.pitch = tofloat(args['--pitch'])
+    a.fov = tofloat(args['--fov'])
+    a.size = tuple(int(x) for x in args['--size'].split('x'))
+    a.link = int(args['--link']) if args['--link'] else None
+    a.since = todate(args['-f'])
+    a.until = todate(args['-u'])
 
     # Params of area
     a.r = tofloat(args['R'])
@@ -1,5 +1,5 @@
 import utm
-from math import sqrt
+from math import sqrt, cos, pi
 
 def circle(latlng_0, r):
     """
@@ -19,6 +19,7 @@ def circle(latlng_0, r):
         x, y = est-easting, nth-northing
         d = sqrt(x**2+y**2)
         return d < r
+    isClose.bbox = utmbox(easting, northing, z_number, z_letter, r, r)
     return isClose
 
 
@@ -43,6 +44,7 @@ def box(latlng_0, w, h=None):
         (est, nth, zn, zl) = utm.from_latlon(ll[0], ll[1], force_zone_number=z_number)
         x, y = est-easting, nth-northing
         return abs(x) < w/2 and abs(y) < h/2
+    isClose.bbox = utmbox(easting, northing, z_number, z_letter, w/2, h/2)
     return isClose
 
 def gpsbox(topleft, btmright):
@@ -56,7 +58,47 @@ def gpsbox(topleft, btmright):
     def isClose(p):
         lt,ln = p.getGPS()
         return lt<=topleft[0] and lt>btmright[0] and ln>=topleft[1] and ln<btmright[1]
+    isClose.bbox = (tuple(topleft), tuple(btmright))
     return isClose
 
+def utmbox(easting, northing, z_number, z_letter, dx, dy):
+    """
+    GPS bounding box of an UTM rectangle centered at easting, northing.
+    :return: tuple - (topleft, btmright), corners (lat, lng)
+    """
+    corners = [utm.to_latlon(easting + sx*dx, northing + sy*dy, z_number, z_letter)
+               for sx in (-1, 1) for sy in (-1, 1)]
+    lats, lngs = zip(*corners)
+    return (max(lats), min(lngs)), (min(lats), max(lngs))
+
+class Point:
+    """ GPS point that can be passed to validators instead of Panorama """
+    def __init__(self, latlng):
+        self.latlng = latlng
+
+    def getGPS(self):
+        return self.latlng
+
+def grid(pvalid, step):
+    """
+    Generates a grid of GPS points inside the validator area.
+    :param pvalid: validator returned by circle(), box() or gpsbox()
+    :param step: float - grid spacing in meters
+    :return: list of tuples (lat, lng)
+    """
+    topleft, btmright = pvalid.bbox
+    dlat = step / 111320.0
+    points = []
+    lat = btmright[0] + dlat/2
+    while lat <= topleft[0]:
+        dlng = dlat / max(cos(lat * pi / 180), 1e-6)
+        lng = topleft[1] + dlng/2
+        while lng < btmright[1]:
+            if pvalid(Point((lat, lng))):
+                points.append((lat, lng))
+            lng += dlng
+        lat += dlat
+    return points
+
 
 